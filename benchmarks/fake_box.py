@@ -0,0 +1,196 @@
+# ベンチマーク用に合成した Box のフォルダツリーと、それを返す Box API の代わり
+# box_connector が使う API だけを実装し、呼び出し回数を数える
+import hashlib
+import io
+import itertools
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+import box_sdk_gen
+
+OWNER = {"type": "user", "id": "1", "login": "owner@example.com"}
+TIMESTAMP = "2024-01-01T00:00:00+00:00"
+
+
+class SyntheticTree:
+    # depth 階層のフォルダツリーを作る
+    # 各フォルダは fanout 個のサブフォルダ (最下層以外) と files_per_folder 個のファイルを持つ
+    # collaboration_density の割合のアイテムにコラボレーションを付ける
+    def __init__(
+        self,
+        root_folder_id: int,
+        depth: int,
+        fanout: int,
+        files_per_folder: int,
+        file_size: int,
+        collaboration_density: float,
+        seed: int = 0,
+    ) -> None:
+        self.root_folder_id = root_folder_id
+        self.content = b"x" * file_size
+        self.sha1 = hashlib.sha1(self.content).hexdigest()
+        self.folders = {}
+        self.files = {}
+        self.children = defaultdict(list)
+        self.collaborations = defaultdict(list)
+        self._ids = itertools.count(root_folder_id + 1)
+        self._random = random.Random(seed)
+        self._collaboration_density = collaboration_density
+
+        self.folders[root_folder_id] = self._folder(root_folder_id, 0)
+        level = [root_folder_id]
+        for current_depth in range(depth):
+            next_level = []
+            for parent_id in level:
+                for _ in range(files_per_folder):
+                    self.add_file(parent_id)
+                if current_depth < depth - 1:
+                    for _ in range(fanout):
+                        next_level.append(self.add_folder(parent_id))
+            level = next_level
+
+    def new_id(self) -> int:
+        return next(self._ids)
+
+    def add_folder(self, parent_id: int) -> int:
+        folder_id = self.new_id()
+        folder = self._folder(folder_id, parent_id)
+        self.folders[folder_id] = folder
+        self.children[parent_id].append(folder)
+        return folder_id
+
+    def add_file(self, parent_id: int) -> int:
+        file_id = self.new_id()
+        file = {
+            "type": "file",
+            "id": str(file_id),
+            "name": f"file-{file_id}.txt",
+            "owned_by": OWNER,
+            "parent": {"type": "folder", "id": str(parent_id)},
+            "created_at": TIMESTAMP,
+            "modified_at": TIMESTAMP,
+            "etag": "0",
+            "sequence_id": "0",
+            "sha1": self.sha1,
+            "file_version": {"type": "file_version", "id": str(file_id)},
+            "has_collaborations": self._add_collaborations(file_id, "file"),
+        }
+        self.files[file_id] = file
+        self.children[parent_id].append(file)
+        return file_id
+
+    def new_collaboration(self, item_id: int, item_type: str) -> dict:
+        collaboration_id = self.new_id()
+        return {
+            "type": "collaboration",
+            "id": str(collaboration_id),
+            "item": {
+                "type": item_type,
+                "id": str(item_id),
+                "name": f"{item_type}-{item_id}.txt",
+            },
+            "accessible_by": {
+                "type": "user",
+                "id": str(collaboration_id),
+                "login": f"user-{collaboration_id}@example.com",
+            },
+            "role": "viewer",
+            "status": "accepted",
+        }
+
+    def _folder(self, folder_id: int, parent_id: int) -> dict:
+        return {
+            "type": "folder",
+            "id": str(folder_id),
+            "name": f"folder-{folder_id}",
+            "owned_by": OWNER,
+            "parent": {"type": "folder", "id": str(parent_id)},
+            "content_modified_at": TIMESTAMP,
+            "etag": "0",
+            "sequence_id": "0",
+            "has_collaborations": self._add_collaborations(folder_id, "folder"),
+        }
+
+    def _add_collaborations(self, item_id: int, item_type: str) -> bool:
+        if self._random.random() >= self._collaboration_density:
+            return False
+        self.collaborations[item_id].append(self.new_collaboration(item_id, item_type))
+        return True
+
+
+class FakeBoxClient:
+    # box_sdk_gen.BoxClient の代わりに SyntheticTree の内容を返す
+    # latency を指定すると 1 回の呼び出しごとにその秒数だけ待つ
+    def __init__(self, tree: SyntheticTree, latency: float = 0.0) -> None:
+        self.tree = tree
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.folders = _Namespace(
+            get_folder_by_id=self._get_folder_by_id,
+            get_folder_items=self._get_folder_items,
+        )
+        self.list_collaborations = _Namespace(
+            get_folder_collaborations=self._get_collaborations,
+            get_file_collaborations=self._get_collaborations,
+        )
+        self.downloads = _Namespace(download_file=self._download_file)
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+
+    def _call(self, endpoint: str) -> None:
+        with self._lock:
+            self.calls[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get_folder_by_id(self, folder_id, fields=None, **kwargs):
+        self._call("get_folder_by_id")
+        return box_sdk_gen.schemas.FolderFull.from_dict(
+            self.tree.folders[int(folder_id)]
+        )
+
+    def _get_folder_items(
+        self, folder_id, fields=None, usemarker=None, marker=None, limit=100, **kwargs
+    ):
+        self._call("get_folder_items")
+        children = self.tree.children[int(folder_id)]
+        start = int(marker or 0)
+        end = start + limit
+        entries = [
+            box_sdk_gen.schemas.FileFull.from_dict(item)
+            if item["type"] == "file"
+            else box_sdk_gen.schemas.FolderMini.from_dict(item)
+            for item in children[start:end]
+        ]
+        return box_sdk_gen.schemas.Items(
+            entries=entries,
+            limit=limit,
+            next_marker=str(end) if end < len(children) else None,
+        )
+
+    def _get_collaborations(self, item_id, **kwargs):
+        self._call("get_collaborations")
+        return box_sdk_gen.schemas.Collaborations(
+            entries=[
+                box_sdk_gen.schemas.Collaboration.from_dict(collaboration)
+                for collaboration in self.tree.collaborations[int(item_id)]
+            ]
+        )
+
+    def _download_file(self, file_id, **kwargs):
+        self._call("download_file")
+        return io.BytesIO(self.tree.content)
+
+
+class _Namespace:
+    def __init__(self, **methods) -> None:
+        self.__dict__.update(methods)
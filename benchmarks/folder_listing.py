@@ -0,0 +1,115 @@
+# フォルダの一覧取得の転送量とレイテンシを、変更前の取得方法と比較する
+# 実際の Box に接続するので box_connector と同じ環境変数と AWS の認証情報が必要
+#
+#   python benchmarks/folder_listing.py <フォルダの ID> [--pages 10]
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str((Path(__file__).parent.parent / "box_connector").resolve()))
+
+import config
+from box import box_client
+from box_crawler import ITEM_FIELDS
+
+# 変更前の box_crawler の FOLDER_FIELDS とページサイズ
+LEGACY_FIELDS = [
+    "id",
+    "type",
+    "name",
+    "item_collection",
+    "owned_by",
+    "parent",
+    "created_at",
+    "modified_at",
+]
+LEGACY_PAGE_SIZE = 1000
+
+
+def list_legacy(folder_id: str, pages: int) -> list[dict]:
+    # 変更前と同じく、オフセットでページングし、空か limit より少ないページで終える
+    results = []
+    offset = 0
+    for _ in range(pages):
+        started_at = time.monotonic()
+        page = box_client.folders.get_folder_items(
+            folder_id,
+            fields=LEGACY_FIELDS,
+            offset=offset,
+            limit=LEGACY_PAGE_SIZE,
+        )
+        results.append(_measure(page, time.monotonic() - started_at))
+
+        if len(page.entries) < LEGACY_PAGE_SIZE:
+            break
+        offset += LEGACY_PAGE_SIZE
+    return results
+
+
+def list_marker(folder_id: str, pages: int) -> list[dict]:
+    # マーカーでページングし、クローラーが使うフィールドだけを取得する
+    results = []
+    marker = None
+    for _ in range(pages):
+        started_at = time.monotonic()
+        page = box_client.folders.get_folder_items(
+            folder_id,
+            fields=ITEM_FIELDS,
+            usemarker=True,
+            marker=marker,
+            limit=config.CRAWLER_PAGE_SIZE,
+        )
+        results.append(_measure(page, time.monotonic() - started_at))
+
+        marker = page.next_marker
+        if not marker:
+            break
+    return results
+
+
+def _measure(page, seconds: float) -> dict:
+    # 転送量はレスポンスの JSON を圧縮せずに数えた値
+    return {
+        "items": len(page.entries),
+        "bytes": len(json.dumps(page.raw_data, separators=(",", ":")).encode()),
+        "seconds": round(seconds, 3),
+    }
+
+
+def summarize(results: list[dict]) -> dict:
+    return {
+        "pages": len(results),
+        "items": sum(r["items"] for r in results),
+        "bytes_per_page": round(statistics.mean(r["bytes"] for r in results)),
+        "bytes_per_item": round(
+            sum(r["bytes"] for r in results) / max(sum(r["items"] for r in results), 1)
+        ),
+        "seconds_per_page": round(statistics.mean(r["seconds"] for r in results), 3),
+        "seconds_per_page_max": max(r["seconds"] for r in results),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder_id")
+    parser.add_argument("--pages", type=int, default=10)
+    args = parser.parse_args()
+
+    legacy = list_legacy(args.folder_id, args.pages)
+    marker = list_marker(args.folder_id, args.pages)
+    print(
+        json.dumps(
+            {
+                "before": {"summary": summarize(legacy), "pages": legacy},
+                "after": {"summary": summarize(marker), "pages": marker},
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# クローラー、イベントハンドラー、S3 への書き込みのスループットを計測する
+# Box は合成したフォルダツリーを返す fake_box.py、S3 と SQS は moto、DB はローカルの Postgres を使う
+# 計測のたびに DB のテーブルを空にするので、DB_HOST などはローカルの Postgres に向けること
+#
+#   python benchmarks/run.py [--depth 3] [--fanout 4] [--files-per-folder 20] ...
+#
+# シナリオごとに別プロセスで準備と計測を行い、計測したプロセスのピーク RSS を報告する
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.resolve()))
+sys.path.append(str((Path(__file__).parent.parent / "box_connector").resolve()))
+
+SCENARIOS = ("crawl", "events", "writer")
+
+# ベンチマーク用の AWS とアプリケーションの設定 (環境変数で上書きできる)
+BENCHMARK_ENV = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "BUCKET_NAME": "benchmark-bucket",
+    "SQS_QUEUE_NAME": "benchmark-queue",
+    "EVENT_CONSUMER_LONG_RUNNING": "False",
+    # 実際の Box クライアントの初期化に失敗したログを出さない
+    "POWERTOOLS_LOG_LEVEL": "CRITICAL",
+}
+
+LOCAL_DB_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--files-per-folder", type=int, default=20)
+    parser.add_argument("--file-size", type=int, default=16 * 1024)
+    parser.add_argument("--collaboration-density", type=float, default=0.1)
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--root-folder-id", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--allow-remote-db", action="store_true")
+    # 子プロセスとして実行する時の引数
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--phase", choices=("setup", "measure"), help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    db_host = os.environ.get("DB_HOST", "")
+    if not (db_host in LOCAL_DB_HOSTS or db_host.startswith("/")):
+        if not args.allow_remote_db:
+            sys.exit(
+                f"DB_HOST={db_host!r} is not a local Postgres."
+                " The benchmark truncates all tables; pass --allow-remote-db to run."
+            )
+
+    env = {**BENCHMARK_ENV, **os.environ}
+    env["BOX_ROOT_FOLDER_IDS"] = str(args.root_folder_id)
+
+    results = []
+    for scenario in args.scenarios:
+        _run_phase(scenario, "setup", env)
+        results.append(_run_phase(scenario, "measure", env))
+
+    print(json.dumps(results, indent=2))
+
+
+def _run_phase(scenario: str, phase: str, env: dict) -> dict:
+    with tempfile.NamedTemporaryFile("r", suffix=".json") as output:
+        subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                *sys.argv[1:],
+                "--child",
+                scenario,
+                "--phase",
+                phase,
+                "--output",
+                output.name,
+            ],
+            env=env,
+            check=True,
+        )
+        return json.loads(output.read() or "{}")
+
+
+def run_child(args: argparse.Namespace) -> None:
+    import logging
+
+    from moto import mock_aws
+
+    with mock_aws():
+        import boto3
+
+        import config
+
+        config.setup_logging(logging.WARNING)
+        region = os.environ["AWS_DEFAULT_REGION"]
+        s3_config = (
+            {"CreateBucketConfiguration": {"LocationConstraint": region}}
+            if region != "us-east-1"
+            else {}
+        )
+        boto3.client("s3").create_bucket(Bucket=config.BUCKET_NAME, **s3_config)
+        boto3.client("sqs").create_queue(QueueName=os.environ["SQS_QUEUE_NAME"])
+
+        import box
+        import box_crawler
+        import event_handler
+        import models
+        import s3_writer
+        from fake_box import FakeBoxClient, SyntheticTree
+
+        tree = SyntheticTree(
+            args.root_folder_id,
+            depth=args.depth,
+            fanout=args.fanout,
+            files_per_folder=args.files_per_folder,
+            file_size=args.file_size,
+            collaboration_density=args.collaboration_density,
+            seed=args.seed,
+        )
+        client = FakeBoxClient(tree, latency=args.latency_ms / 1000)
+        for module in (box, box_crawler, s3_writer):
+            module.box_client = client
+
+        if args.phase == "setup":
+            _setup(args.child, models, box_crawler, s3_writer, client)
+            return
+
+        if args.child == "crawl":
+            _truncate(models)
+            target, items = box_crawler.main, len(tree.folders) + len(tree.files)
+        elif args.child == "events":
+            _send_events(tree, args.events, args.seed)
+            target, items = event_handler.main, args.events
+        else:
+            target, items = s3_writer.write_files, len(tree.files)
+
+        client.reset()
+        queries = _count_queries(models.db)
+        started_at = time.monotonic()
+        target()
+        seconds = time.monotonic() - started_at
+
+        result = {
+            "scenario": args.child,
+            "items": items,
+            "seconds": round(seconds, 3),
+            "items_per_second": round(items / seconds, 1),
+            "box_api_calls_per_item": round(client.total_calls() / items, 3),
+            "db_queries_per_item": round(queries() / items, 3),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "box_api_calls": dict(client.calls),
+        }
+        with open(args.output, "w") as f:
+            json.dump(result, f)
+
+
+def _setup(scenario, models, box_crawler, s3_writer, client) -> None:
+    # 計測の対象より前の処理を済ませて DB に記録する
+    _truncate(models)
+    if scenario == "crawl":
+        return
+
+    models.db.connect(reuse_if_open=True)
+    root_folder = client.folders.get_folder_by_id(
+        str(client.tree.root_folder_id), fields=box_crawler.FOLDER_FIELDS
+    )
+    box_crawler.crawl([root_folder])
+    if scenario == "events":
+        s3_writer.write_files()
+
+
+def _truncate(models) -> None:
+    models.create_tables()
+    models.db.execute_sql(
+        "TRUNCATE " + ", ".join(model._meta.table_name for model in models.MODELS)
+    )
+
+
+def _send_events(tree, count: int, seed: int) -> None:
+    # ファイルのアップロードと名前の変更、フォルダへのコラボレーションの追加、
+    # 最下層のフォルダの移動を順番に送る
+    import boto3
+
+    sqs_client = boto3.client("sqs")
+    queue_url = sqs_client.get_queue_url(QueueName=os.environ["SQS_QUEUE_NAME"])[
+        "QueueUrl"
+    ]
+
+    rng = random.Random(seed)
+    folder_ids = list(tree.folders)
+    file_ids = list(tree.files)
+    leaf_folder_ids = [
+        folder_id
+        for folder_id in folder_ids
+        if folder_id != tree.root_folder_id
+        and not any(item["type"] == "folder" for item in tree.children[folder_id])
+    ]
+    rng.shuffle(leaf_folder_ids)
+
+    payloads = []
+    for index in range(count):
+        kind = index % 4
+        if kind == 0:
+            file_id = tree.add_file(rng.choice(folder_ids))
+            payload = {"trigger": "FILE.UPLOADED", "source": tree.files[file_id]}
+        elif kind == 1:
+            file_id = rng.choice(file_ids)
+            source = {**tree.files[file_id], "name": f"renamed-{index}.txt"}
+            payload = {"trigger": "FILE.RENAMED", "source": source}
+        elif kind == 2:
+            collaboration = tree.new_collaboration(rng.choice(folder_ids), "folder")
+            payload = {"trigger": "COLLABORATION.ACCEPTED", "source": collaboration}
+        elif leaf_folder_ids:
+            source = {
+                **tree.folders[leaf_folder_ids.pop()],
+                "parent": {"type": "folder", "id": str(tree.root_folder_id)},
+            }
+            payload = {"trigger": "FOLDER.MOVED", "source": source}
+        else:
+            file_id = rng.choice(file_ids)
+            source = {**tree.files[file_id], "name": f"renamed-{index}.txt"}
+            payload = {"trigger": "FILE.RENAMED", "source": source}
+        payloads.append(payload)
+
+    for start in range(0, len(payloads), 10):
+        sqs_client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(index), "MessageBody": json.dumps(payload)}
+                for index, payload in enumerate(payloads[start : start + 10])
+            ],
+        )
+
+
+def _count_queries(db):
+    # DB のインスタンスの execute_sql を差し替えて、実行したクエリの数を数える
+    count = 0
+    lock = threading.Lock()
+    execute_sql = db.execute_sql
+
+    def counting_execute_sql(*args, **kwargs):
+        nonlocal count
+        with lock:
+            count += 1
+        return execute_sql(*args, **kwargs)
+
+    db.execute_sql = counting_execute_sql
+    return lambda: count
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss は Linux では KB、macOS ではバイト
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak_rss / 1024 / 1024
+    return peak_rss / 1024
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,212 @@
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
 import box_sdk_gen
 import boto3
+import requests
 from aws_lambda_powertools import Logger
+# SDK の内部のモジュール (requirements.txt で box-sdk-gen のバージョンを固定している)
+from box_sdk_gen.networking.box_network_client import (
+    APIRequest,
+    APIResponse,
+    BoxNetworkClient,
+)
+from box_sdk_gen.networking.fetch_options import FetchOptions
+from box_sdk_gen.networking.fetch_response import FetchResponse
+from requests.adapters import HTTPAdapter
+
+import config
 
 ssm_client = boto3.client("ssm")
 logger = Logger()
 
+# レイテンシのヒストグラムの上限値 (秒)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class RateLimiter:
+    # トークンバケットでリクエストの間隔を制御する
+    # 429 が返ってきたら全スレッドを Retry-After の間止めて、レートを下げる
+    # 成功が続いたら少しずつ BOX_API_RATE_LIMIT までレートを戻す
+    def __init__(self, rate: float, burst: int) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = max(
+                    self._paused_until - now, (1 - self._tokens) / self.rate
+                )
+            time.sleep(wait)
+
+    def throttle(self, retry_after: float) -> None:
+        with self._lock:
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + retry_after
+            )
+            self.rate = max(self.max_rate / 10, self.rate / 2)
+            self._tokens = 0
+
+    def recover(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class BoxApiStats:
+    # エンドポイントごとのリクエスト数やレイテンシを集計する
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._endpoints = defaultdict(
+            lambda: {
+                "calls": 0,
+                "errors": 0,
+                "seconds": 0.0,
+                "latency": [0] * len(LATENCY_BUCKETS),
+            }
+        )
+        self.throttles = 0
+        self.retries = 0
+
+    def record(self, endpoint: str, seconds: float, is_error: bool) -> None:
+        with self._lock:
+            stats = self._endpoints[endpoint]
+            stats["calls"] += 1
+            stats["errors"] += int(is_error)
+            stats["seconds"] += seconds
+            for i, bucket in enumerate(LATENCY_BUCKETS):
+                if seconds <= bucket:
+                    stats["latency"][i] += 1
+                    break
+
+    def record_throttle(self) -> None:
+        with self._lock:
+            self.throttles += 1
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "calls": sum(s["calls"] for s in self._endpoints.values()),
+                "throttles": self.throttles,
+                "retries": self.retries,
+                "endpoints": {
+                    endpoint: {
+                        "calls": s["calls"],
+                        "errors": s["errors"],
+                        "seconds": round(s["seconds"], 3),
+                        "latency": {
+                            f"le_{bucket}": count
+                            for bucket, count in zip(LATENCY_BUCKETS, s["latency"])
+                        },
+                    }
+                    for endpoint, s in self._endpoints.items()
+                },
+            }
+
+
+class RateLimitedNetworkClient(BoxNetworkClient):
+    # SDK のリトライも含めて全ての HTTP リクエストをレート制限して計測する
+    # SDK の内部のメソッド _make_request を上書きしているので、
+    # box-sdk-gen のバージョンを上げる時はシグネチャと呼び出され方が変わっていないか確認する
+    def __init__(self, rate_limiter: RateLimiter, stats: BoxApiStats) -> None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=config.BOX_API_MAX_CONNECTIONS)
+        session.mount("https://", adapter)
+        super().__init__(requests_session=session)
+        self.rate_limiter = rate_limiter
+        self.stats = stats
+
+    def _make_request(self, request: APIRequest) -> APIResponse:
+        self.rate_limiter.acquire()
+        started_at = time.monotonic()
+        response = super()._make_request(request)
+
+        status = (
+            response.network_response.status_code
+            if response.network_response is not None
+            else 0
+        )
+        self.stats.record(
+            _get_endpoint(request.method, request.url),
+            time.monotonic() - started_at,
+            not 200 <= status < 400,
+        )
+        if 200 <= status < 400:
+            self.rate_limiter.recover()
+        return response
+
+
+class RateLimitedRetryStrategy(box_sdk_gen.BoxRetryStrategy):
+    # Retry-After に従って待機し、ない場合はジッター付きの指数バックオフで待機する
+    def __init__(self, rate_limiter: RateLimiter, stats: BoxApiStats) -> None:
+        super().__init__(max_attempts=config.BOX_API_MAX_ATTEMPTS)
+        self.rate_limiter = rate_limiter
+        self.stats = stats
+
+    def should_retry(
+        self,
+        fetch_options: FetchOptions,
+        fetch_response: FetchResponse,
+        attempt_number: int,
+    ) -> bool:
+        should_retry = super().should_retry(
+            fetch_options, fetch_response, attempt_number
+        )
+        if should_retry:
+            self.stats.record_retry()
+        return should_retry
+
+    def retry_after(
+        self,
+        fetch_options: FetchOptions,
+        fetch_response: FetchResponse,
+        attempt_number: int,
+    ) -> float:
+        seconds = super().retry_after(fetch_options, fetch_response, attempt_number)
+        if fetch_response.status == 429:
+            # 複数のスレッドが同時に再開しないようにずらす
+            seconds *= random.uniform(1, 1 + self.retry_randomization_factor)
+            self.stats.record_throttle()
+            self.rate_limiter.throttle(seconds)
+        return seconds
+
+
+def _get_endpoint(method: str, url: str) -> str:
+    # ID をまとめてエンドポイントごとに集計する
+    path = re.sub(r"/\d+(?=/|$)", "/{id}", urlparse(url).path)
+    return f"{method} {path}"
+
+
+# レート制限は同時に実行するプロセスで等分する
+rate_limiter = RateLimiter(
+    config.BOX_API_RATE_LIMIT / config.BOX_API_PROCESSES,
+    max(config.BOX_API_BURST // config.BOX_API_PROCESSES, 1),
+)
+box_api_stats = BoxApiStats()
+
 
 def initialize_box_client() -> box_sdk_gen.BoxClient:
     try:
@@ -15,7 +217,11 @@ def initialize_box_client() -> box_sdk_gen.BoxClient:
         parameter_value = response["Parameter"]["Value"]
         box_config = box_sdk_gen.JWTConfig.from_config_json_string(parameter_value)
         box_auth = box_sdk_gen.BoxJWTAuth(config=box_config)
-        return box_sdk_gen.BoxClient(auth=box_auth)
+        network_session = box_sdk_gen.NetworkSession(
+            network_client=RateLimitedNetworkClient(rate_limiter, box_api_stats),
+            retry_strategy=RateLimitedRetryStrategy(rate_limiter, box_api_stats),
+        )
+        return box_sdk_gen.BoxClient(auth=box_auth, network_session=network_session)
     except Exception as e:
         logger.error(
             {
@@ -1,54 +1,514 @@
+import argparse
 import box_sdk_gen
 import logging
-from typing import Union
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Callable, Iterator, Optional, Union
 
 import config
-from box import box_client
+from box import box_api_stats, box_client
 import event_handler
+from metrics import log_run_summary, metrics
 import s3_writer
-from models import db, File, Folder, Collaboration
+from models import (
+    db,
+    create_tables,
+    Model,
+    File,
+    Folder,
+    Collaboration,
+    CrawlFrontier,
+    CrawlRun,
+    rebuild_folder_access,
+)
+import utils
 
 logger = logging.getLogger("box_crawler")
 
+# Box から取得するフィールド
+# item_collection などの使わないフィールドは取得しない
 FOLDER_FIELDS = [
     "id",
     "type",
     "name",
-    "item_collection",
+    "owned_by",
+    "parent",
+    "content_modified_at",
+    "etag",
+    "sequence_id",
+    "has_collaborations",
+]
+FILE_FIELDS = [
+    "id",
+    "type",
+    "name",
     "owned_by",
     "parent",
     "created_at",
     "modified_at",
+    "etag",
+    "sequence_id",
+    "sha1",
+    "file_version",
+    "has_collaborations",
 ]
+# フォルダの一覧取得ではアイテムの種類ごとに該当するフィールドだけが返される
+ITEM_FIELDS = sorted(set(FOLDER_FIELDS) | set(FILE_FIELDS))
+
+# 走査したフォルダの変更判定用の値 (フォルダの ID → 値)
+# crawl_frontier に記録し、配下を含めてクロールが完了した時にまとめて保存する
+_folder_watermarks = {}
+
+
+class BulkUpserter:
+    # クロールで見つけた行を溜めておき、insert_many でまとめて upsert する
+    # 書き込みはロックを取ったまま行うので、flush から戻った時点で
+    # 他のスレッドが追加した行も含めて DB に書き込まれている
+    # 書き込みに失敗した行は次の flush で書き込み直す
+    def __init__(self, batch_size: int) -> None:
+        self.batch_size = batch_size
+        self._rows = {File: {}, Folder: {}, Collaboration: {}}
+        self._lock = threading.Lock()
+
+    def add(self, model: type[Model], data: dict) -> None:
+        with self._lock:
+            self._rows[model][data["id"]] = data
+            if len(self._rows[model]) >= self.batch_size:
+                self._write(model)
+
+    def flush(self) -> None:
+        with self._lock:
+            for model in self._rows:
+                if self._rows[model]:
+                    self._write(model)
+
+    def _write(self, model: type[Model]) -> None:
+        self._upsert(model, self._rows[model])
+        self._rows[model] = {}
+
+    @staticmethod
+    def _upsert(model: type[Model], rows: dict) -> None:
+        # ロックの順番を揃えるために ID 順に書き込む
+        data = [rows[key] for key in sorted(rows, key=int)]
+        preserve = [model._meta.fields[name] for name in data[0] if name != "id"]
+        with db.atomic():
+            model.insert_many(data).on_conflict(
+                conflict_target=[model.id], preserve=preserve
+            ).execute()
+
+
+upserter = BulkUpserter(config.CRAWLER_BATCH_SIZE)
+
+# 単独のクロールで、ページの追加と完了を待機中のスレッドに知らせる
+# 版はページを追加・完了するたびに増やす
+_frontier_changed = threading.Condition()
+_frontier_version = 0
+
+
+def crawl_folder_page(
+    folder_id: str, offset: int = 0, marker: Optional[str] = None
+) -> list[Callable]:
+    # フォルダの 1 ページ分を取得し、後続のタスクを返す
+    # アイテム数の多いフォルダでも遅くならないようにマーカーでページングする
+    # offset はページの識別と進捗の記録に使う
+    page = box_client.folders.get_folder_items(
+        folder_id,
+        fields=ITEM_FIELDS,
+        usemarker=True,
+        marker=marker,
+        limit=config.CRAWLER_PAGE_SIZE,
+    )
+    items = page.entries
+
+    tasks = get_item_tasks(items)
+
+    # 次のページがあればマーカーを引き継いで取得する
+    if page.next_marker:
+        tasks.append(
+            partial(crawl_folder_page, folder_id, offset + len(items), page.next_marker)
+        )
+
+    return tasks
+
+
+def get_item_tasks(items: list) -> list[Callable]:
+    # DB に記録済みかどうかはページごとに 1 回のクエリでまとめて調べる
+    files, folders = _find_existing_items(items)
+
+    tasks = []
+    skipped = Counter()
+    for item in items:
+        if isinstance(item, box_sdk_gen.schemas.folder_mini.FolderMini):
+            watermark = _get_folder_watermark(item)
+            if config.INCREMENTAL_CRAWL and _is_unchanged_folder(
+                folders.get(int(item.id)), watermark
+            ):
+                skipped["crawler.folders_skipped"] += 1
+                continue
+            tasks.append(
+                partial(visit_folder, item, watermark, int(item.id) in folders)
+            )
+
+        elif isinstance(item, box_sdk_gen.schemas.file_full.FileFull):
+            if config.INCREMENTAL_CRAWL and _is_unchanged_file(
+                files.get(int(item.id)), item
+            ):
+                skipped["crawler.files_skipped"] += 1
+                continue
+            if config.SKIP_EXISTING_ITEMS and int(item.id) in files:
+                skipped["crawler.files_skipped"] += 1
+                continue
+            tasks.append(partial(visit_file, item))
 
+    for name, count in skipped.items():
+        metrics.increment(name, count)
+    return tasks
 
-def crawl_folder(folder_id, limit=1000) -> None:
-    offset = 0
 
-    while True:
-        items = [
-            i
-            for i in box_client.folders.get_folder_items(
-                folder_id, limit=limit, offset=offset, fields=FOLDER_FIELDS
-            ).entries
+def visit_folder(
+    folder: Union[
+        box_sdk_gen.schemas.FolderMini,
+        box_sdk_gen.schemas.FolderFull,
+    ],
+    watermark: dict,
+    exists: bool,
+) -> list[Callable]:
+    if config.SKIP_EXISTING_ITEMS and exists:
+        metrics.increment("crawler.folders_skipped")
+    else:
+        process_folder(folder)
+    _folder_watermarks[folder.id] = watermark
+    return [partial(crawl_folder_page, folder.id, 0, None)]
+
+
+def visit_file(file: box_sdk_gen.schemas.FileFull) -> list[Callable]:
+    process_file(file)
+    return []
+
+
+def _find_existing_items(items: list) -> tuple[dict, dict]:
+    # ファイルの ID → etag と、フォルダの ID → (etag, content_modified_at) を返す
+    file_ids = [
+        int(item.id)
+        for item in items
+        if isinstance(item, box_sdk_gen.schemas.file_full.FileFull)
+    ]
+    folder_ids = [
+        int(item.id)
+        for item in items
+        if isinstance(item, box_sdk_gen.schemas.folder_mini.FolderMini)
+    ]
+
+    files = {}
+    if file_ids:
+        files = dict(
+            File.select(File.id, File.etag).where(File.id.in_(file_ids)).tuples()
+        )
+
+    folders = {}
+    if folder_ids:
+        folders = {
+            folder_id: (etag, content_modified_at)
+            for folder_id, etag, content_modified_at in Folder.select(
+                Folder.id, Folder.etag, Folder.content_modified_at
+            )
+            .where(Folder.id.in_(folder_ids))
+            .tuples()
+        }
+
+    return files, folders
+
+
+def _get_folder_watermark(
+    folder: Union[
+        box_sdk_gen.schemas.FolderMini,
+        box_sdk_gen.schemas.FolderFull,
+    ],
+) -> dict:
+    data = folder.to_dict()
+    return {
+        "etag": data.get("etag"),
+        "sequence_id": data.get("sequence_id"),
+        "content_modified_at": utils.to_utc(data.get("content_modified_at")),
+    }
+
+
+def _is_unchanged_folder(stored: Optional[tuple], watermark: dict) -> bool:
+    if stored is None or watermark["content_modified_at"] is None:
+        return False
+    return stored == (watermark["etag"], watermark["content_modified_at"])
+
+
+def _is_unchanged_file(
+    stored_etag: Optional[str], file: box_sdk_gen.schemas.FileFull
+) -> bool:
+    return file.etag is not None and stored_etag == file.etag
+
+
+def crawl(folders: list, resume: bool = False) -> None:
+    # クロールするフォルダのページを crawl_frontier テーブルに記録しながら走査する
+    # ページは一覧取得とアイテムの処理が終わってから完了にするので、
+    # 途中で停止しても resume=True で未完了のページから再開できる
+    # CRAWLER_DISTRIBUTED が True なら複数のタスクでページを分担する
+    # 確保したページは CRAWLER_CLAIM_TIMEOUT_SECONDS の間は他のタスクから処理されず、
+    # 期限が切れたページ (タスクが停止した場合など) は他のタスクが処理し直す
+    if not config.CRAWLER_DISTRIBUTED:
+        _reset_frontier(resume)
+    elif not config.CRAWLER_RUN_ID:
+        raise ValueError("CRAWLER_RUN_ID is required when CRAWLER_DISTRIBUTED is True")
+    _seed_frontier(folders)
+
+    with ThreadPoolExecutor(
+        max_workers=config.CRAWLER_MAX_WORKERS
+    ) as page_executor, ThreadPoolExecutor(
+        max_workers=config.CRAWLER_MAX_WORKERS
+    ) as item_executor:
+        stopped = threading.Event()
+        futures = [
+            page_executor.submit(_run_frontier_worker, item_executor, stopped)
+            for _ in range(config.CRAWLER_MAX_WORKERS)
         ]
+        # エラーで停止したスレッドがあれば他のスレッドも止める
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        stopped.set()
+        _notify_frontier()
+        for future in done:
+            future.result()
+
+    _finish_frontier()
 
-        if not items:
-            break
 
-        for item in items:
-            if isinstance(item, box_sdk_gen.schemas.folder_mini.FolderMini):
-                process_folder(item)
-                crawl_folder(item.id)
+def _reset_frontier(resume: bool) -> None:
+    if not resume:
+        # 前回の途中までのクロールは破棄してルートフォルダからやり直す
+        rebuild_folder_access()
+        CrawlFrontier.delete().execute()
+        return
+
+    # 前回のタスクは停止しているので、期限を待たずに確保していたページを処理し直す
+    CrawlFrontier.update(claimed_until=None).where(~CrawlFrontier.is_done).execute()
+    logger.info(
+        {
+            "text": "Resume crawling",
+            "done_pages": CrawlFrontier.select()
+            .where(CrawlFrontier.is_done)
+            .count(),
+            "pending_pages": CrawlFrontier.select()
+            .where(~CrawlFrontier.is_done)
+            .count(),
+        }
+    )
+
+
+def _seed_frontier(folders: list) -> None:
+    with db.atomic():
+        # 同時に起動したタスクのうち最初の 1 つだけがルートフォルダを登録する
+        db.execute_sql(
+            f"LOCK TABLE {CrawlFrontier._meta.table_name} IN EXCLUSIVE MODE"
+        )
+        if config.CRAWLER_DISTRIBUTED:
+            # 同じ実行の他のタスクが登録済みなら登録しない
+            # 他のタスクがクロールを終えて crawl_frontier を片付けた後に起動したタスクが、
+            # 新しいクロールを始めないようにするため
+            if CrawlRun.get_or_none(CrawlRun.run_id == config.CRAWLER_RUN_ID):
+                return
+            CrawlRun.create(run_id=config.CRAWLER_RUN_ID)
+        if CrawlFrontier.select().exists():
+            return
+
+        pages = []
+        for task in get_item_tasks(folders):
+            pages.extend(task())
+        upserter.flush()
+        _add_frontier_pages(pages)
 
-            elif isinstance(item, box_sdk_gen.schemas.file_full.FileFull):
-                process_file(item)
 
-        # limit より取得できた item 数 が少なかったらループを抜ける
-        if len(items) < limit:
-            break
+def _run_frontier_worker(
+    item_executor: ThreadPoolExecutor, stopped: threading.Event
+) -> None:
+    # 終了する時に DB の接続をプールに戻す
+    with db.connection_context():
+        while not stopped.is_set():
+            # ページを確保する前の版を覚えておき、確保してから待つまでの間に
+            # 追加されたページを見逃さないようにする
+            version = _frontier_version
+            page = _claim_frontier_page()
+            if page is not None:
+                _crawl_frontier_page(page, item_executor)
+                continue
+
+            # 処理中のページから新しいフォルダが見つかることがあるので
+            # 未完了のページがなくなるまで待つ
+            if not CrawlFrontier.select().where(~CrawlFrontier.is_done).exists():
+                return
+            _wait_for_frontier(stopped, version)
+
+
+def _wait_for_frontier(stopped: threading.Event, version: int) -> None:
+    # 分散クロールでは他のタスクが追加したページを知る方法がないので DB をポーリングする
+    # 単独のクロールではこのプロセスのスレッドだけがページを追加・完了するので、
+    # 通知を受けるまで待つ (通知を取りこぼしても CRAWLER_POLL_INTERVAL_SECONDS で再確認する)
+    if config.CRAWLER_DISTRIBUTED:
+        stopped.wait(config.CRAWLER_POLL_INTERVAL_SECONDS)
+        return
+    with _frontier_changed:
+        _frontier_changed.wait_for(
+            lambda: stopped.is_set() or _frontier_version != version,
+            timeout=config.CRAWLER_POLL_INTERVAL_SECONDS,
+        )
+
+
+def _notify_frontier() -> None:
+    global _frontier_version
+    with _frontier_changed:
+        _frontier_version += 1
+        _frontier_changed.notify_all()
+
+
+def _claim_deadline() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(
+        seconds=config.CRAWLER_CLAIM_TIMEOUT_SECONDS
+    )
+
+
+def _claim_frontier_page() -> Optional[CrawlFrontier]:
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    candidate = CrawlFrontier.alias()
+    candidates = (
+        candidate.select(candidate.id)
+        .where(
+            ~candidate.is_done
+            & (candidate.claimed_until.is_null() | (candidate.claimed_until < now))
+        )
+        .order_by(candidate.id)
+        .limit(1)
+        .for_update("FOR UPDATE SKIP LOCKED")
+    )
+    with db.atomic():
+        pages = list(
+            CrawlFrontier.update(claimed_until=_claim_deadline())
+            .where(CrawlFrontier.id.in_(candidates))
+            .returning(CrawlFrontier)
+            .execute()
+        )
+    return pages[0] if pages else None
+
+
+def _crawl_frontier_page(
+    page: CrawlFrontier, item_executor: ThreadPoolExecutor
+) -> None:
+    # ページ内のアイテムを並列に処理し、見つけたフォルダと次のページを登録する
+    with metrics.timer("crawler.page"), _keep_claimed(page):
+        pages = []
+        items = []
+        for task in crawl_folder_page(
+            str(page.folder_id), page.page_offset, page.marker
+        ):
+            (pages if task.func is crawl_folder_page else items).append(task)
+        for tasks in item_executor.map(_run_item_task, items):
+            pages.extend(tasks)
+
+        # アイテムが DB に書き込まれてからページを完了にする
+        upserter.flush()
+        with db.atomic():
+            _add_frontier_pages(pages)
+            CrawlFrontier.update(is_done=True, claimed_until=None).where(
+                CrawlFrontier.id == page.id
+            ).execute()
+    # コミットしてから待機中のスレッドに追加したページと完了を知らせる
+    _notify_frontier()
+    metrics.increment("crawler.pages")
 
-        offset += limit
+
+@contextmanager
+def _keep_claimed(page: CrawlFrontier) -> Iterator[None]:
+    # 処理している間は CRAWLER_CLAIM_TIMEOUT_SECONDS の半分ごとに確保の期限を延ばす
+    # レート制限を分け合うタスクが多いと 1 ページの処理に時間がかかり、
+    # 期限が切れると他のタスクが同じページを処理し直してしまうため
+    # 期限が切れて他のタスクに確保し直されたページは延長しない
+    done = threading.Event()
+
+    def renew() -> None:
+        claimed_until = page.claimed_until
+        while not done.wait(config.CRAWLER_CLAIM_TIMEOUT_SECONDS / 2):
+            deadline = _claim_deadline()
+            with db.connection_context():
+                renewed = (
+                    CrawlFrontier.update(claimed_until=deadline)
+                    .where(
+                        (CrawlFrontier.id == page.id)
+                        & (CrawlFrontier.claimed_until == claimed_until)
+                    )
+                    .execute()
+                )
+            if not renewed:
+                return
+            claimed_until = deadline
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+
+
+def _run_item_task(task: Callable) -> list[Callable]:
+    with db.connection_context():
+        return task()
+
+
+def _add_frontier_pages(tasks: list[Callable]) -> None:
+    rows = []
+    for task in tasks:
+        folder_id, offset, marker = task.args
+        watermark = {"etag": None, "sequence_id": None, "content_modified_at": None}
+        if offset == 0:
+            watermark = _folder_watermarks.pop(folder_id, watermark)
+        rows.append(
+            {
+                "folder_id": int(folder_id),
+                "page_offset": offset,
+                "marker": marker,
+                **watermark,
+            }
+        )
+
+    if rows:
+        CrawlFrontier.insert_many(rows).on_conflict_ignore().execute()
+
+
+def _finish_frontier() -> None:
+    with db.atomic():
+        # 最初に完了したタスクだけがフォルダの差分クロール用の値と
+        # フォルダのアクセス権を保存して片付ける
+        db.execute_sql(
+            f"LOCK TABLE {CrawlFrontier._meta.table_name} IN EXCLUSIVE MODE"
+        )
+        if (
+            not CrawlFrontier.select().exists()
+            or CrawlFrontier.select().where(~CrawlFrontier.is_done).exists()
+        ):
+            return
+
+        Folder.update(
+            etag=CrawlFrontier.etag,
+            sequence_id=CrawlFrontier.sequence_id,
+            content_modified_at=CrawlFrontier.content_modified_at,
+        ).from_(CrawlFrontier).where(
+            (Folder.id == CrawlFrontier.folder_id) & (CrawlFrontier.page_offset == 0)
+        ).execute()
+        rebuild_folder_access()
+        CrawlFrontier.delete().execute()
+        if config.CRAWLER_DISTRIBUTED:
+            CrawlRun.update(
+                finished_at=datetime.now(timezone.utc).replace(tzinfo=None)
+            ).where(CrawlRun.run_id == config.CRAWLER_RUN_ID).execute()
 
 
 def process_folder(
@@ -57,12 +517,11 @@ def process_folder(
         box_sdk_gen.schemas.FolderFull,
     ],
 ) -> None:
-    if config.SKIP_EXISTING_ITEMS and Folder.get_or_none(Folder.id == folder.id):
+    upserter.add(Folder, event_handler.build_folder_data(folder.to_dict()))
+    metrics.increment("crawler.folders")
+    if not _has_collaborations(folder):
         return
 
-    event_handler.process_folder_events(
-        {"trigger": "FOLDER.CREATED", "source": folder.to_dict()}
-    )
     for collaboration in box_client.list_collaborations.get_folder_collaborations(
         folder.id
     ).entries:
@@ -71,12 +530,16 @@ def process_folder(
 
 
 def process_file(file: box_sdk_gen.schemas.FileFull) -> None:
-    if config.SKIP_EXISTING_ITEMS and File.get_or_none(File.id == file.id):
+    data = event_handler.build_file_data(file.to_dict())
+    if data is None:
+        metrics.increment("crawler.files_unsupported")
+        return
+
+    upserter.add(File, data)
+    metrics.increment("crawler.files")
+    if not _has_collaborations(file):
         return
 
-    event_handler.process_file_events(
-        {"trigger": "FILE.UPLOADED", "source": file.to_dict()}
-    )
     for collaboration in box_client.list_collaborations.get_file_collaborations(
         file.id
     ).entries:
@@ -84,27 +547,50 @@ def process_file(file: box_sdk_gen.schemas.FileFull) -> None:
             process_collaboration(collaboration)
 
 
+def _has_collaborations(
+    item: Union[
+        box_sdk_gen.schemas.FolderMini,
+        box_sdk_gen.schemas.FolderFull,
+        box_sdk_gen.schemas.FileFull,
+    ],
+) -> bool:
+    # 一覧取得で has_collaborations が False のアイテムはコラボレーションを取得しない
+    # 値が返されなかった場合は取得する
+    if getattr(item, "has_collaborations", None) is False:
+        metrics.increment("crawler.collaboration_calls_saved")
+        return False
+    metrics.increment("crawler.collaboration_calls")
+    return True
+
+
 def process_collaboration(collaboration: box_sdk_gen.schemas.Collaboration) -> None:
     if collaboration.status != "accepted":
         return
-    event_handler.process_collaboration_events(
-        {"trigger": "COLLABORATION.ACCEPTED", "source": collaboration.to_dict()}
-    )
 
+    data = event_handler.build_collaboration_data(collaboration.to_dict())
+    if data is not None:
+        upserter.add(Collaboration, data)
 
-def main() -> None:
-    db.connect()
-    db.create_tables([File, Folder, Collaboration])
 
-    for folder_id in config.BOX_ROOT_FOLDER_IDS:
-        root_folder = box_client.folders.get_folder_by_id(
-            folder_id, fields=FOLDER_FIELDS
-        )
-        process_folder(root_folder)
-        crawl_folder(root_folder.id)
+def main(resume: bool = False) -> None:
+    db.connect(reuse_if_open=True)
+    create_tables()
+
+    root_folders = [
+        box_client.folders.get_folder_by_id(folder_id, fields=FOLDER_FIELDS)
+        for folder_id in config.BOX_ROOT_FOLDER_IDS
+    ]
+    crawl(root_folders, resume=resume)
 
     s3_writer.write_files()
+    log_run_summary("crawler", box_api=box_api_stats.summary())
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="前回停止したクロールを未完了のページから再開する",
+    )
+    main(resume=parser.parse_args().resume)
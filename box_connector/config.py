@@ -32,11 +32,81 @@ SUPPORT_FILE_TYPES = (
     "TXT",
 )
 
+# [box.py]
+# Box API に 1 秒あたりに送るリクエスト数の上限
+# Box のユーザーごとのレート制限に合わせて設定する
+BOX_API_RATE_LIMIT = float(os.environ.get("BOX_API_RATE_LIMIT", "15"))
+# 一時的にレートを超えて送れるリクエスト数
+BOX_API_BURST = int(os.environ.get("BOX_API_BURST", "15"))
+# Box API の 1 リクエストあたりの最大試行回数
+BOX_API_MAX_ATTEMPTS = int(os.environ.get("BOX_API_MAX_ATTEMPTS", "8"))
+# Box API への同時接続数の上限
+BOX_API_MAX_CONNECTIONS = int(os.environ.get("BOX_API_MAX_CONNECTIONS", "32"))
+# Box API のレート制限を分け合う、同時に実行するプロセス数
+# 分散クロールで複数のタスクを起動する場合はタスクの数を指定する
+BOX_API_PROCESSES = max(int(os.environ.get("BOX_API_PROCESSES", "1")), 1)
+
 # [box_crawler.py]
 # TrueならDBに記録されているファイルとフォルダは処理をスキップする
 SKIP_EXISTING_ITEMS = strtobool(os.environ.get("SKIP_EXISTING_ITEMS", "False"))
+# Trueなら前回のクロールから変更されていないフォルダとファイルは処理をスキップする
+# コラボレーションの変更だけではスキップの判定に影響しないので Webhook で反映する
+INCREMENTAL_CRAWL = strtobool(os.environ.get("INCREMENTAL_CRAWL", "False"))
 # 処理対象とするBoxのフォルダのID
 BOX_ROOT_FOLDER_IDS = list(map(int, os.environ["BOX_ROOT_FOLDER_IDS"].split(",")))
+# フォルダの一覧取得とコラボレーションの取得を並列に実行するスレッド数
+CRAWLER_MAX_WORKERS = int(os.environ.get("CRAWLER_MAX_WORKERS", "8"))
+# クロールで見つけたアイテムを DB にまとめて書き込む件数
+CRAWLER_BATCH_SIZE = int(os.environ.get("CRAWLER_BATCH_SIZE", "500"))
+# フォルダの一覧取得で 1 ページあたりに取得するアイテム数
+CRAWLER_PAGE_SIZE = int(os.environ.get("CRAWLER_PAGE_SIZE", "1000"))
+# Trueならクロールするフォルダを DB (crawl_frontier) で共有し、複数のタスクで分担する
+CRAWLER_DISTRIBUTED = strtobool(os.environ.get("CRAWLER_DISTRIBUTED", "False"))
+# 分散クロールの実行の ID (分散クロールでは必須)
+# 同じ ID で起動したタスクが 1 つのクロールを分担する
+# 完了したクロールと同じ ID で起動したタスクは新しいクロールを始めない
+CRAWLER_RUN_ID = os.environ.get("CRAWLER_RUN_ID", "")
+# 分散クロールで確保したフォルダを他のタスクが処理しない秒数
+# 処理している間はこの半分ごとに期限を延ばし、停止したタスクのフォルダは他のタスクが処理し直す
+CRAWLER_CLAIM_TIMEOUT_SECONDS = int(
+    os.environ.get("CRAWLER_CLAIM_TIMEOUT_SECONDS", "600")
+)
+# 分散クロールで処理できるフォルダがない時に、他のタスクの完了を待つ間隔 (秒)
+CRAWLER_POLL_INTERVAL_SECONDS = float(
+    os.environ.get("CRAWLER_POLL_INTERVAL_SECONDS", "5")
+)
+
+# [event_handler.py]
+# 1 回の処理でまとめて受信するメッセージ数の上限
+EVENT_BATCH_SIZE = int(os.environ.get("EVENT_BATCH_SIZE", "100"))
+# イベントを並列に処理するスレッド数
+# 同じファイルのイベントは同じスレッドで順番に処理される
+# SQS のメッセージグループはアイテムごとに分かれているので複数のスレッドで処理する
+EVENT_CONSUMER_WORKERS = int(os.environ.get("EVENT_CONSUMER_WORKERS", "4"))
+# True ならキューが空になっても終了せずに新しいイベントを待ち続ける
+EVENT_CONSUMER_LONG_RUNNING = strtobool(
+    os.environ.get("EVENT_CONSUMER_LONG_RUNNING", "False")
+)
+# 常駐する場合にロングポーリングで待機する秒数
+EVENT_CONSUMER_WAIT_TIME_SECONDS = 20
+# 常駐する場合に、続けてイベントを処理する秒数の上限
+# イベントが届き続けてキューが空にならなくても、この時間ごとに S3 へ書き込む
+EVENT_CONSUMER_CYCLE_SECONDS = int(
+    os.environ.get("EVENT_CONSUMER_CYCLE_SECONDS", "300")
+)
+# SQS からの受信を同時に実行するスレッド数
+# 1 回の受信で返るメッセージは最大 10 件なので、同時に受信して待ち時間を重ねる
+EVENT_CONSUMER_RECEIVERS = int(os.environ.get("EVENT_CONSUMER_RECEIVERS", "4"))
+# 処理に失敗したイベントを再試行する回数の上限 (最初の処理を含む)
+EVENT_RETRY_MAX_ATTEMPTS = int(os.environ.get("EVENT_RETRY_MAX_ATTEMPTS", "5"))
+# 失敗したイベントを再試行するまでの秒数 (失敗するたびに 2 倍にする)
+EVENT_RETRY_BASE_DELAY_SECONDS = int(
+    os.environ.get("EVENT_RETRY_BASE_DELAY_SECONDS", "60")
+)
+# 再試行するまでの秒数の上限
+EVENT_RETRY_MAX_DELAY_SECONDS = int(
+    os.environ.get("EVENT_RETRY_MAX_DELAY_SECONDS", "3600")
+)
 
 # [s3_writer.py]
 # アップロード先のS3バケット
@@ -47,6 +117,44 @@ S3_DOCUMENT_KEY_PREFIX = "docs/"
 METADATA_FILE_SUFFIX = ".metadata.json"
 # メタデータに埋め込まれるBoxのURLのPrefix
 SOURCE_URI_PREFIX = "https://app.box.com/"
+# Box からのダウンロードを並列に実行するスレッド数
+WRITER_DOWNLOAD_WORKERS = int(os.environ.get("WRITER_DOWNLOAD_WORKERS", "4"))
+# S3 へのアップロードを並列に実行するスレッド数
+WRITER_UPLOAD_WORKERS = int(os.environ.get("WRITER_UPLOAD_WORKERS", "4"))
+# 各ステージの間で待機できるファイル数の上限
+WRITER_QUEUE_SIZE = int(os.environ.get("WRITER_QUEUE_SIZE", "8"))
+# DB から 1 度に確保して処理するファイル数
+WRITER_BATCH_SIZE = int(os.environ.get("WRITER_BATCH_SIZE", "1000"))
+# ファイルの内容を書き込む時に DB から 1 度に確保するファイル数
+# 転送に時間がかかるので、確保した期限内に処理し終わるよう少しずつ確保する
+WRITER_FILE_CLAIM_SIZE = int(os.environ.get("WRITER_FILE_CLAIM_SIZE", "50"))
+# アップロードの結果を DB にまとめて反映するファイル数の上限
+WRITER_COMMIT_BATCH_SIZE = int(os.environ.get("WRITER_COMMIT_BATCH_SIZE", "100"))
+# 確保したファイルを他の s3_writer が処理しない秒数
+# この時間内に処理が終わらなかったファイルは他の s3_writer が処理し直す
+WRITER_CLAIM_TIMEOUT_SECONDS = int(
+    os.environ.get("WRITER_CLAIM_TIMEOUT_SECONDS", "1800")
+)
+# Box からダウンロードした内容をキャッシュするディレクトリ (空ならキャッシュしない)
+# 書き込みに失敗したファイルを再実行した時に Box からダウンロードし直さない
+WRITER_DOWNLOAD_CACHE_DIR = os.environ.get("WRITER_DOWNLOAD_CACHE_DIR", "")
+# キャッシュの合計サイズの上限 (バイト)
+# 超えた分は最後に使われたのが古いものから削除する
+WRITER_DOWNLOAD_CACHE_MAX_BYTES = int(
+    os.environ.get("WRITER_DOWNLOAD_CACHE_MAX_BYTES", str(10 * 1024**3))
+)
+# S3 へマルチパートアップロードする時のパートサイズ (5 MiB 以上)
+# 1 ファイルの転送で保持するメモリはこのサイズまでになる
+S3_MULTIPART_PART_SIZE = max(
+    int(os.environ.get("S3_MULTIPART_PART_SIZE", str(8 * 1024 * 1024))),
+    5 * 1024 * 1024,
+)
+
+# [metrics.py]
+# 実行の集計を CloudWatch の Embedded Metric Format (EMF) でも出力するか
+METRICS_EMF = strtobool(os.environ.get("METRICS_EMF", "False"))
+# EMF で出力するメトリクスの名前空間
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "KendraBoxConnector")
 
 
 class CustomJsonFormatter(jsonlogger.JsonFormatter):
@@ -1,21 +1,39 @@
 import os
 import json
+import time
 import traceback
 import logging
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from dateutil import parser
-from datetime import timezone
-from typing import Callable
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional
 
 import boto3
 
+import config
+from box import box_api_stats
+from metrics import log_run_summary, metrics
 import s3_writer
-from models import db, File, Folder, Collaboration
+from models import (
+    db,
+    create_tables,
+    grant_collaboration_access,
+    move_folder_access,
+    revoke_collaboration_access,
+    update_folder_access,
+    File,
+    Folder,
+    Collaboration,
+    FailedEvent,
+)
 import utils
 
 
 logger = logging.getLogger("event_handler")
 sqs_client = boto3.client("sqs")
+metrics.instrument_boto3_client(sqs_client, "sqs")
 s3_client = boto3.client("s3")
 ssm_client = boto3.client("ssm")
 
@@ -26,40 +44,213 @@ class ProcessingFailed(Exception):
         super().__init__(message)
 
 
-def consume_messages() -> None:
+# 同じファイルに対する後続のイベントで上書きされるイベントのグループ
+_FILE_EVENT_GROUPS = {
+    "FILE.TRASHED": "trash",
+    "FILE.RESTORED": "trash",
+    "FILE.RENAMED": "name",
+    "FILE.MOVED": "parent",
+}
+
+# ファイルの全ての状態を上書きするイベント
+_FILE_EVENTS_OVERWRITING_ALL = ("FILE.UPLOADED", "FILE.DELETED")
+
+
+def consume_messages(
+    wait_time_seconds: int = 0, max_seconds: Optional[float] = None
+) -> None:
+    # キューが空になるか、max_seconds を過ぎるまで受信と処理を繰り返す
     queue_url = sqs_client.get_queue_url(
         QueueName=os.environ["SQS_QUEUE_NAME"],
     )["QueueUrl"]
 
     count = 0
+    coalesced_count = 0
+    started_at = time.monotonic()
 
-    while True:
-        res = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
+    with ThreadPoolExecutor(
+        max_workers=config.EVENT_CONSUMER_WORKERS
+    ) as executor, ThreadPoolExecutor(
+        max_workers=config.EVENT_CONSUMER_RECEIVERS
+    ) as receivers:
+        while max_seconds is None or time.monotonic() - started_at < max_seconds:
+            messages = _receive_messages(queue_url, receivers, wait_time_seconds)
+
+            if not messages:
+                break
+
+            events = _coalesce_events(messages)
+            coalesced_count += len(messages) - len(events)
+            metrics.increment("events.received", len(messages))
+            metrics.increment("events.coalesced", len(messages) - len(events))
+            receipt_handles = []
+
+            for partitions in _partition_events(events, config.EVENT_CONSUMER_WORKERS):
+                for handles in executor.map(_process_events, partitions):
+                    receipt_handles.extend(handles)
+
+            _delete_messages(queue_url, receipt_handles)
+            count += len(receipt_handles)
+
+    if count > 0:
+        logger.info(
+            f"{str(count)} messages have been completed."
+            f" ({str(coalesced_count)} messages were coalesced)"
+        )
+    else:
+        logger.info("There were no messages.")
+
+
+def _receive_messages(
+    queue_url: str, receivers: ThreadPoolExecutor, wait_time_seconds: int = 0
+) -> list[dict]:
+    # EVENT_BATCH_SIZE を EVENT_CONSUMER_RECEIVERS 個に分けて同時に受信する
+    # FIFO キューでは受信中のメッセージグループの後続は他の受信にも返らないので、
+    # 同じアイテムのメッセージが別々の受信に分かれることはない
+    # ロングポーリングで待機するのは 1 つ目の受信だけにして、
+    # 他の受信が空のキューを待ち続けて処理が遅れないようにする
+    count = min(config.EVENT_CONSUMER_RECEIVERS, config.EVENT_BATCH_SIZE)
+    sizes = [
+        config.EVENT_BATCH_SIZE // count + (index < config.EVENT_BATCH_SIZE % count)
+        for index in range(count)
+    ]
+    wait_times = [wait_time_seconds] + [0] * (count - 1)
+
+    messages = []
+    for received in receivers.map(
+        lambda size, wait_time: _receive_batch(queue_url, size, wait_time),
+        sizes,
+        wait_times,
+    ):
+        messages.extend(received)
+    return messages
+
+
+def _receive_batch(queue_url: str, size: int, wait_time_seconds: int) -> list[dict]:
+    # 受信できなくなるか size に達するまでまとめて受信する
+    # FIFO キューでは受信中のメッセージグループの後続は受信できないが、
+    # グループは Box のアイテムごとなので、他のアイテムのメッセージを続けて受信できる
+    # ロングポーリングで待機するのは最初の受信だけ
+    messages = []
+
+    while len(messages) < size:
+        res = sqs_client.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=min(10, size - len(messages)),
+            WaitTimeSeconds=0 if messages else wait_time_seconds,
+        )
 
         if "Messages" not in res:
             break
 
-        for message in res["Messages"]:
-            receipt_handle = message["ReceiptHandle"]
-            payload = json.loads(message["Body"])
+        messages.extend(res["Messages"])
 
-            try:
-                logger.debug(payload)
-                event_group, _ = payload["trigger"].split(".")
+    return messages
 
-                if event_group == "FILE":
-                    process_file_events(payload)
-                elif event_group == "FOLDER":
-                    process_folder_events(payload)
-                elif event_group == "COLLABORATION":
-                    process_collaboration_events(payload)
 
-                sqs_client.delete_message(
-                    QueueUrl=queue_url, ReceiptHandle=receipt_handle
-                )
-                count += 1
+def _coalesce_events(messages: list[dict]) -> list[tuple[dict, list[str]]]:
+    # 同じファイルに対する連続したイベントを最終的な結果が同じになるようにまとめる
+    # フォルダとコラボレーションのイベントは複数のファイルに影響するので、
+    # それより前のイベントが後のイベントにまとめられることはない
+    events = []
+    latest = {}
+
+    for message in messages:
+        payload = json.loads(message["Body"])
+        handles = [message["ReceiptHandle"]]
+        trigger = payload["trigger"]
+
+        if not trigger.startswith("FILE."):
+            latest = {}
+            events.append((payload, handles))
+            continue
+
+        file_groups = latest.setdefault(str(payload["source"]["id"]), {})
+
+        if trigger in _FILE_EVENTS_OVERWRITING_ALL:
+            superseded = list(file_groups.values())
+            file_groups.clear()
+            group = "all"
+        elif trigger in _FILE_EVENT_GROUPS:
+            group = _FILE_EVENT_GROUPS[trigger]
+            superseded = [file_groups[group]] if group in file_groups else []
+        else:
+            events.append((payload, handles))
+            continue
+
+        for index in sorted(superseded, reverse=True):
+            handles = events[index][1] + handles
+            events[index] = None
+
+        file_groups[group] = len(events)
+        events.append((payload, handles))
+
+    return [event for event in events if event]
+
+
+def _process_event(payload: dict) -> None:
+    event_group, _ = payload["trigger"].split(".")
+
+    if event_group == "FILE":
+        process_file_events(payload)
+    elif event_group == "FOLDER":
+        process_folder_events(payload)
+    elif event_group == "COLLABORATION":
+        process_collaboration_events(payload)
+
+
+def _partition_events(
+    events: list[tuple[dict, list[str]]], workers: int
+) -> Iterator[list[list[tuple[dict, list[str]]]]]:
+    # ファイルのイベントはファイルの ID ごとにスレッドへ振り分ける
+    # フォルダとコラボレーションのイベントは配下のファイルに影響するので、
+    # 前のイベントが全て終わってから単独で処理する
+    partitions = [[] for _ in range(workers)]
+
+    for event in events:
+        payload = event[0]
+        if payload["trigger"].startswith("FILE."):
+            partitions[int(payload["source"]["id"]) % workers].append(event)
+            continue
+
+        if any(partitions):
+            yield [partition for partition in partitions if partition]
+            partitions = [[] for _ in range(workers)]
+        yield [[event]]
+
+    if any(partitions):
+        yield [partition for partition in partitions if partition]
+
+
+def _process_events(events: list[tuple[dict, list[str]]]) -> list[str]:
+    # まとめて 1 つのトランザクションで処理し、処理できたメッセージの ReceiptHandle を返す
+    # ワーカーのスレッドで実行されるので、終わったら DB の接続をプールに戻す
+    receipt_handles = []
+
+    with db.connection_context(), db.atomic():
+        # 再試行を待っているイベントがあるアイテムのイベントは、
+        # 先に処理すると再試行で古い状態に戻るので処理せずに後ろに並べる
+        parked_item_ids = _parked_item_ids(
+            [_get_item_id(payload) for payload, _ in events]
+        )
+
+        for payload, handles in events:
+            if _get_item_id(payload) in parked_item_ids:
+                if _park_event(payload, attempts=0):
+                    receipt_handles.extend(handles)
+                    metrics.increment("events.deferred")
+                continue
+
+            try:
+                logger.debug(payload)
+                # 失敗したイベントだけロールバックする
+                with metrics.timer(f"events.{payload['trigger']}"), db.atomic():
+                    _process_event(payload)
+                receipt_handles.extend(handles)
+                metrics.increment("events.processed")
 
             except Exception as e:
+                metrics.increment("events.failed")
                 logger.error(
                     {
                         "text": "Error processing payload",
@@ -68,160 +259,275 @@ def consume_messages() -> None:
                         "traceback": traceback.format_exc(),
                     }
                 )
+                # 失敗したイベントは再試行のテーブルに移してメッセージを削除する
+                # FIFO キューで後続のメッセージが止まらないようにするため
+                # テーブルに移せなかった場合はメッセージを残して SQS から再受信する
+                if _park_event(payload, attempts=1, error=e):
+                    receipt_handles.extend(handles)
+                    parked_item_ids.add(_get_item_id(payload))
+                    metrics.increment("events.parked")
+
+    return receipt_handles
+
+
+def _get_item_id(payload: dict) -> str:
+    return str((payload.get("source") or {}).get("id", ""))
+
+
+def _parked_item_ids(item_ids: list[str]) -> set[str]:
+    # 上限まで失敗して再試行しないイベントは後続のイベントを止めない
+    query = FailedEvent.select(FailedEvent.item_id).where(
+        FailedEvent.item_id.in_(item_ids)
+        & (FailedEvent.attempts < config.EVENT_RETRY_MAX_ATTEMPTS)
+    )
+    return {item_id for item_id, in query.tuples()}
+
+
+def _park_event(
+    payload: dict, attempts: int, error: Optional[Exception] = None
+) -> bool:
+    try:
+        with db.atomic():
+            FailedEvent.create(
+                payload=json.dumps(payload),
+                item_id=_get_item_id(payload),
+                attempts=attempts,
+                # 順番を待っているだけのイベントは前のイベントが終わればすぐ処理する
+                next_attempt_at=_utcnow()
+                + (_retry_delay(attempts) if attempts else timedelta()),
+                last_error=str(error) if error else None,
+            )
+    except Exception as e:
+        logger.error(
+            {
+                "text": "Error parking payload",
+                "payload": payload,
+                "error": str(e),
+            }
+        )
+        return False
+
+    return True
+
+
+def retry_failed_events() -> None:
+    # 再試行の時刻を過ぎた失敗したイベントを古い順に処理する
+    # 処理中の行はロックしておき、他のイベントハンドラーからは処理されない
+    # 同じアイテムのイベントは順番に処理し、前のイベントが残っている間は後続を処理しない
+    # EVENT_RETRY_MAX_ATTEMPTS 回失敗したイベントは再試行せずにテーブルに残す
+    with db.connection_context(), db.atomic():
+        events = list(
+            FailedEvent.select()
+            .where(
+                (FailedEvent.next_attempt_at <= _utcnow())
+                & (FailedEvent.attempts < config.EVENT_RETRY_MAX_ATTEMPTS)
+            )
+            .order_by(FailedEvent.id)
+            .limit(config.EVENT_BATCH_SIZE)
+            .for_update("FOR UPDATE SKIP LOCKED")
+        )
+        pending = _pending_event_ids({event.item_id for event in events})
 
-    if count > 0:
-        logger.info(f"{str(count)} messages have been completed.")
-    else:
-        logger.info("There were no messages.")
+        for event in events:
+            # 同じアイテムのより古いイベントが残っていれば待つ
+            if pending[event.item_id][0] != event.id:
+                continue
 
+            payload = json.loads(event.payload)
+            try:
+                with metrics.timer(f"events.{payload['trigger']}"), db.atomic():
+                    _process_event(payload)
+            except Exception as e:
+                event.attempts += 1
+                event.next_attempt_at = _utcnow() + _retry_delay(event.attempts)
+                event.last_error = str(e)
+                event.save()
+                metrics.increment("events.retry_failed")
+                if event.attempts >= config.EVENT_RETRY_MAX_ATTEMPTS:
+                    metrics.increment("events.abandoned")
+                    logger.error(
+                        {
+                            "text": "Giving up retrying payload",
+                            "payload": payload,
+                            "attempts": event.attempts,
+                            "error": str(e),
+                        }
+                    )
+                continue
+
+            event.delete_instance()
+            pending[event.item_id].popleft()
+            metrics.increment("events.retried")
+
+
+def _pending_event_ids(item_ids: set[str]) -> dict[str, deque]:
+    # アイテムごとに、再試行を待っているイベントの ID を古い順に返す
+    # 再試行の時刻前のものや他のイベントハンドラーが処理中のものも含める
+    pending = defaultdict(deque)
+    for event_id, item_id in (
+        FailedEvent.select(FailedEvent.id, FailedEvent.item_id)
+        .where(
+            FailedEvent.item_id.in_(list(item_ids))
+            & (FailedEvent.attempts < config.EVENT_RETRY_MAX_ATTEMPTS)
+        )
+        .order_by(FailedEvent.id)
+        .tuples()
+    ):
+        pending[item_id].append(event_id)
+    return pending
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    return timedelta(
+        seconds=min(
+            config.EVENT_RETRY_BASE_DELAY_SECONDS * 2 ** (attempts - 1),
+            config.EVENT_RETRY_MAX_DELAY_SECONDS,
+        )
+    )
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _delete_messages(queue_url: str, receipt_handles: list[str]) -> None:
+    # delete_message_batch は 1 回で 10 件まで削除できる
+    for i in range(0, len(receipt_handles), 10):
+        res = sqs_client.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(j), "ReceiptHandle": receipt_handle}
+                for j, receipt_handle in enumerate(receipt_handles[i : i + 10])
+            ],
+        )
+        for failed in res.get("Failed", []):
+            logger.error({"text": "Failed to delete message", "error": failed})
 
-def _trash_file(file: File) -> None:
-    # Trash されたら S3 から削除する
-    # Restore されたら Box から再度ダウンロードする
-    file.is_trashed = True
-    file.file_needs_update = True
-    file.metadata_needs_update = True
 
+# Trash されたら S3 から削除する
+# Restore されたら Box から再度ダウンロードする
+# フラグを立てる時は s3_writer の確保 (claimed_until) も外す
+# 処理中の s3_writer はこの更新を上書きせず、次回の実行で再処理する
+_TRASH_ITEM = {
+    File.is_trashed: True,
+    File.file_needs_update: True,
+    File.metadata_needs_update: True,
+    File.claimed_until: None,
+}
 
-def _delete_item(file: File) -> None:
-    file.is_deleted = True
-    file.file_needs_update = True
-    file.metadata_needs_update = True
+_DELETE_ITEM = {
+    File.is_deleted: True,
+    File.file_needs_update: True,
+    File.metadata_needs_update: True,
+    File.claimed_until: None,
+}
 
+_RESTORE_ITEM = {
+    File.is_trashed: False,
+    File.file_needs_update: True,
+    File.metadata_needs_update: True,
+    File.claimed_until: None,
+}
 
-def _restore_item(file: File) -> None:
-    file.is_trashed = False
-    file.file_needs_update = True
-    file.metadata_needs_update = True
+_MARK_ITEM_METADATA_NEEDS_UPDATE = {
+    File.metadata_needs_update: True,
+    File.claimed_until: None,
+}
 
 
-def _mark_item_metadata_needs_update(file: File) -> None:
-    file.metadata_needs_update = True
+def _update_file(file_id: int, values: dict) -> int:
+    return File.update(values).where(File.id == file_id).execute()
 
 
 def process_file_events(payload: dict) -> None:
     trigger = payload["trigger"]
 
     if trigger == "FILE.TRASHED":
-        file = File.get_or_none(File.id == payload["source"]["id"])
-        if file:
-            _trash_file(file)
-            file.save()
+        _update_file(payload["source"]["id"], _TRASH_ITEM)
 
     elif trigger == "FILE.DELETED":
-        file = File.get_or_none(File.id == payload["source"]["id"])
-        if file:
-            _delete_item(file)
-            file.save()
+        _update_file(payload["source"]["id"], _DELETE_ITEM)
 
     elif trigger == "FILE.RESTORED":
-        file = File.get_or_none(File.id == payload["source"]["id"])
-        if file:
-            _restore_item(file)
-            file.save()
+        _update_file(payload["source"]["id"], _RESTORE_ITEM)
 
     elif trigger == "FILE.UPLOADED":
-        name = payload["source"]["name"]
-        if not utils.is_support_file(name):
+        data = build_file_data(payload["source"])
+        if data is None:
             return
 
-        owner_type, owner_name = _get_accessible_type_and_name(
-            payload["source"]["owned_by"]
-        )
-
-        data = {
-            "id": payload["source"]["id"],
-            "name": name,
-            "parent_id": payload["source"]["parent"]["id"],
-            "owner_type": owner_type,
-            "owner_name": owner_name,
-            "created_at": parser.parse(payload["source"]["created_at"]).astimezone(
-                timezone.utc
-            ),
-            "last_updated_at": parser.parse(
-                payload["source"]["modified_at"]
-            ).astimezone(timezone.utc),
-            "is_trashed": False,
-            "is_deleted": False,
-            "file_needs_update": True,
-            "metadata_needs_update": True,
-        }
-
         query = File.insert(data).on_conflict(conflict_target=[File.id], update=data)
         query.execute()
 
     elif trigger == "FILE.MOVED":
-        file = File.get_or_none(File.id == payload["source"]["id"])
-        if file:
-            file.parent_id = payload["source"]["parent"]["id"]
-            file.metadata_needs_update = True
-            file.save()
+        _update_file(
+            payload["source"]["id"],
+            {
+                File.parent_id: payload["source"]["parent"]["id"],
+                **_MARK_ITEM_METADATA_NEEDS_UPDATE,
+            },
+        )
 
     elif trigger == "FILE.COPIED":
         # 新しくコピーされたファイルに対して UPLOADED イベントが発生する
         pass
 
     elif trigger == "FILE.RENAMED":
-        file = File.get_or_none(File.id == payload["source"]["id"])
-        if file:
-            file.name = payload["source"]["name"]
-            file.metadata_needs_update = True
-            file.save()
+        _update_file(
+            payload["source"]["id"],
+            {File.name: payload["source"]["name"], **_MARK_ITEM_METADATA_NEEDS_UPDATE},
+        )
 
 
-def _update_folder_recursively(folder_id: int, function: Callable) -> None:
-    folder = Folder.get(Folder.id == folder_id)
+def _update_folder_recursively(folder_id: int, values: dict) -> int:
+    # 再帰 CTE でフォルダ配下の全フォルダを求め、その中のファイルを一括で更新する
+    base = (
+        Folder.select(Folder.id)
+        .where(Folder.id == folder_id)
+        .cte("descendants", recursive=True)
+    )
+    child = Folder.alias()
+    recursive = child.select(child.id).join(base, on=(child.parent_id == base.c.id))
+    descendants = base.union_all(recursive)
 
-    for sub_folder in Folder.select().where(Folder.parent_id == folder.id):
-        _update_folder_recursively(sub_folder.id, function)
+    folder_ids = descendants.select_from(descendants.c.id)
 
-    for file in File.select().where(File.parent_id == folder.id):
-        function(file)
-        file.save()
+    count = File.update(values).where(File.parent_id.in_(folder_ids)).execute()
+    logger.debug(
+        {"text": "Updated files in folder", "folder_id": folder_id, "count": count}
+    )
+    return count
 
 
 def process_folder_events(payload: dict) -> None:
     trigger = payload["trigger"]
 
     if trigger == "FOLDER.CREATED":
-        owner_type, owner_name = _get_accessible_type_and_name(
-            payload["source"]["owned_by"]
-        )
-
-        try:
-            parent_id = payload["source"]["parent"]["id"]
-        except KeyError:
-            parent_id = None
-
-        data = {
-            "id": payload["source"]["id"],
-            "name": payload["source"]["name"],
-            "parent_id": parent_id,
-            "owner_type": owner_type,
-            "owner_name": owner_name,
-        }
+        data = build_folder_data(payload["source"])
 
         query = Folder.insert(data).on_conflict(
             conflict_target=[Folder.id], update=data
         )
         query.execute()
+        update_folder_access(int(data["id"]), _to_id(data["parent_id"]))
 
     elif trigger == "FOLDER.TRASHED":
-        _update_folder_recursively(payload["source"]["id"], _trash_file)
+        _update_folder_recursively(payload["source"]["id"], _TRASH_ITEM)
 
     elif trigger == "FOLDER.DELETED":
-        _update_folder_recursively(payload["source"]["id"], _delete_item)
+        _update_folder_recursively(payload["source"]["id"], _DELETE_ITEM)
 
     elif trigger == "FOLDER.RESTORED":
-        _update_folder_recursively(payload["source"]["id"], _restore_item)
+        _update_folder_recursively(payload["source"]["id"], _RESTORE_ITEM)
 
     elif trigger == "FOLDER.MOVED":
         folder = Folder.get(Folder.id == payload["source"]["id"])
         folder.parent_id = payload["source"]["parent"]["id"]
         folder.save()
+        move_folder_access(folder.id, _to_id(folder.parent_id))
         # 子アイテムの ACL を作成し直す
         _update_folder_recursively(
-            payload["source"]["id"], _mark_item_metadata_needs_update
+            payload["source"]["id"], _MARK_ITEM_METADATA_NEEDS_UPDATE
         )
 
     elif trigger == "FOLDER.COPIED":
@@ -240,60 +546,114 @@ def process_collaboration_events(payload: dict) -> None:
         pass
 
     elif trigger == "COLLABORATION.ACCEPTED":
-        collaboration_id = payload["source"]["id"]
-        item_id = payload["source"]["item"]["id"]
-        item_type = payload["source"]["item"]["type"]
-
-        if item_type == 'file':
-            if not utils.is_support_file(payload["source"]["item"]["name"]):
-                return
-
-        accessible_type, accessible_name = _get_accessible_type_and_name(
-            payload["source"]["accessible_by"]
-        )
-
-        data = {
-            "id": collaboration_id,
-            "item_id": item_id,
-            "item_type": item_type,
-            "accessible_type": accessible_type,
-            "accessible_name": accessible_name,
-            "status": payload["source"]["status"],
-        }
+        data = build_collaboration_data(payload["source"])
+        if data is None:
+            return
 
         query = Collaboration.insert(data).on_conflict(
             conflict_target=[Collaboration.id], update=data
         )
         query.execute()
 
-        if item_type == "file":
-            file = File.get_or_none(File.id == item_id)
-            if file:
-                _mark_item_metadata_needs_update(file)
-                file.save()
+        if data["item_type"] == "file":
+            _update_file(data["item_id"], _MARK_ITEM_METADATA_NEEDS_UPDATE)
         else:
-            _update_folder_recursively(item_id, _mark_item_metadata_needs_update)
+            grant_collaboration_access(data)
+            _update_folder_recursively(
+                data["item_id"], _MARK_ITEM_METADATA_NEEDS_UPDATE
+            )
 
     elif trigger == "COLLABORATION.REMOVED":
         collaboration = Collaboration.get(Collaboration.id == payload["source"]["id"])
 
         if collaboration.item_type == "file":
-            file = File.get(File.id == collaboration.item_id)
-            if file:
-                _mark_item_metadata_needs_update(file)
-                file.save()
+            _update_file(collaboration.item_id, _MARK_ITEM_METADATA_NEEDS_UPDATE)
         else:
+            revoke_collaboration_access(collaboration.id)
             _update_folder_recursively(
-                collaboration.item_id, _mark_item_metadata_needs_update
+                collaboration.item_id, _MARK_ITEM_METADATA_NEEDS_UPDATE
             )
 
-        collaboration.delete()
+        collaboration.delete_instance()
 
     elif trigger == "COLLABORATION.UPDATED":
         # どのロールも読み取り権限はあるので考慮しない
         pass
 
 
+def build_file_data(source: dict) -> Optional[dict]:
+    # 対象外の拡張子のファイルは None を返す
+    name = source["name"]
+    if not utils.is_support_file(name):
+        return
+
+    owner_type, owner_name = _get_accessible_type_and_name(source["owned_by"])
+
+    return {
+        "id": source["id"],
+        "name": name,
+        "parent_id": source["parent"]["id"],
+        "owner_type": owner_type,
+        "owner_name": owner_name,
+        "created_at": parser.parse(source["created_at"]).astimezone(timezone.utc),
+        "last_updated_at": parser.parse(source["modified_at"]).astimezone(
+            timezone.utc
+        ),
+        "is_trashed": False,
+        "is_deleted": False,
+        "file_needs_update": True,
+        "metadata_needs_update": True,
+        "claimed_until": None,
+        "etag": source.get("etag"),
+        "sequence_id": source.get("sequence_id"),
+        "sha1": source.get("sha1"),
+        "version_id": (source.get("file_version") or {}).get("id"),
+    }
+
+
+def build_folder_data(source: dict) -> dict:
+    owner_type, owner_name = _get_accessible_type_and_name(source["owned_by"])
+
+    try:
+        parent_id = source["parent"]["id"]
+    except KeyError:
+        parent_id = None
+
+    return {
+        "id": source["id"],
+        "name": source["name"],
+        "parent_id": parent_id,
+        "owner_type": owner_type,
+        "owner_name": owner_name,
+    }
+
+
+def build_collaboration_data(source: dict) -> Optional[dict]:
+    # 対象外の拡張子のファイルへのコラボレーションは None を返す
+    item_type = source["item"]["type"]
+
+    if item_type == "file":
+        if not utils.is_support_file(source["item"]["name"]):
+            return
+
+    accessible_type, accessible_name = _get_accessible_type_and_name(
+        source["accessible_by"]
+    )
+
+    return {
+        "id": source["id"],
+        "item_id": source["item"]["id"],
+        "item_type": item_type,
+        "accessible_type": accessible_type,
+        "accessible_name": accessible_name,
+        "status": source["status"],
+    }
+
+
+def _to_id(value: Optional[str]) -> Optional[int]:
+    return int(value) if value is not None else None
+
+
 def _get_accessible_type_and_name(accessible_dict: dict) -> (str, str):
     if accessible_dict["type"] == "user":
         return accessible_dict["type"], accessible_dict["login"].replace(" ", "+")
@@ -301,10 +661,26 @@ def _get_accessible_type_and_name(accessible_dict: dict) -> (str, str):
 
 
 def main() -> None:
-    db.connect()
-    db.create_tables([File, Folder, Collaboration])
-    consume_messages()
-    s3_writer.write_files()
+    db.connect(reuse_if_open=True)
+    create_tables()
+
+    if not config.EVENT_CONSUMER_LONG_RUNNING:
+        consume_messages()
+        retry_failed_events()
+        s3_writer.write_files()
+        log_run_summary("event_handler", box_api=box_api_stats.summary())
+        return
+
+    # キューが空になるか EVENT_CONSUMER_CYCLE_SECONDS が経つたびに S3 へ書き込み、
+    # また新しいイベントを待つ
+    while True:
+        consume_messages(
+            config.EVENT_CONSUMER_WAIT_TIME_SECONDS,
+            config.EVENT_CONSUMER_CYCLE_SECONDS,
+        )
+        retry_failed_events()
+        s3_writer.write_files()
+        log_run_summary("event_handler", box_api=box_api_stats.summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Iterator
+
+import config
+
+logger = logging.getLogger("metrics")
+
+# EMF の 1 つのディレクティブに含められるメトリクス数の上限
+_EMF_MAX_METRICS = 100
+
+
+class Metrics:
+    # 処理ごとの所要時間と件数を集計し、実行の終わりにまとめて出力する
+    # 複数のスレッドから記録されるのでロックを取って更新する
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._started_at = time.monotonic()
+            self._counters = Counter()
+            self._timers = defaultdict(
+                lambda: {"calls": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+
+    def increment(self, name: str, count: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += count
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            timer = self._timers[name]
+            timer["calls"] += 1
+            timer["seconds"] += seconds
+            timer["max_seconds"] = max(timer["max_seconds"], seconds)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        # 例外で抜けた場合も所要時間を記録する
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started_at)
+
+    def instrument_boto3_client(self, client, prefix: str) -> None:
+        # boto3 のイベントで API の呼び出しごとの所要時間とエラー数を記録する
+        # context はリクエストごとに作られ、呼び出しの前後で同じものが渡される
+        service = client.meta.service_model.service_id.hyphenize()
+
+        def before_call(context: dict, **kwargs) -> None:
+            context["metrics_started_at"] = time.monotonic()
+
+        def after_call(context: dict, event_name: str, **kwargs) -> None:
+            started_at = context.pop("metrics_started_at", None)
+            if started_at is None:
+                return
+            operation = event_name.split(".")[-1]
+            self.record(f"{prefix}.{operation}", time.monotonic() - started_at)
+            if "exception" in kwargs:
+                self.increment(f"{prefix}.errors")
+
+        client.meta.events.register(f"before-call.{service}", before_call)
+        client.meta.events.register(f"after-call.{service}", after_call)
+        client.meta.events.register(f"after-call-error.{service}", after_call)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "seconds": round(time.monotonic() - self._started_at, 3),
+                "counters": dict(self._counters),
+                "timers": {
+                    name: {
+                        "calls": timer["calls"],
+                        "seconds": round(timer["seconds"], 3),
+                        "max_seconds": round(timer["max_seconds"], 3),
+                    }
+                    for name, timer in self._timers.items()
+                },
+            }
+
+
+metrics = Metrics()
+
+
+def log_run_summary(run: str, **extra) -> None:
+    # 実行ごとの集計を JSON で出力し、次の実行のために集計をやり直す
+    # METRICS_EMF が True なら CloudWatch の Embedded Metric Format でも出力する
+    summary = metrics.summary()
+    logger.info({"text": "Run summary", "run": run, **summary, **extra})
+    if config.METRICS_EMF:
+        logger.info(_to_emf(run, summary))
+    metrics.reset()
+
+
+def _to_emf(run: str, summary: dict) -> dict:
+    values = {"run.seconds": summary["seconds"]}
+    units = {"run.seconds": "Seconds"}
+    for name, count in summary["counters"].items():
+        values[name] = count
+        units[name] = "Count"
+    for name, timer in summary["timers"].items():
+        values[f"{name}.calls"] = timer["calls"]
+        units[f"{name}.calls"] = "Count"
+        values[f"{name}.seconds"] = timer["seconds"]
+        units[f"{name}.seconds"] = "Seconds"
+
+    definitions = [{"Name": name, "Unit": unit} for name, unit in units.items()]
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": config.METRICS_NAMESPACE,
+                    "Dimensions": [["Run"]],
+                    "Metrics": definitions[i : i + _EMF_MAX_METRICS],
+                }
+                for i in range(0, len(definitions), _EMF_MAX_METRICS)
+            ],
+        },
+        "Run": run,
+        **values,
+    }
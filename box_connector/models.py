@@ -1,14 +1,38 @@
 import os
+from typing import Optional
 
 from peewee import *
+from peewee import CTE
+from playhouse.migrate import PostgresqlMigrator, migrate
+from playhouse.pool import PooledPostgresqlDatabase
 
+import config
+from metrics import metrics
 
-db = PostgresqlDatabase(
+
+class InstrumentedPostgresqlDatabase(PooledPostgresqlDatabase):
+    # 全てのクエリの所要時間を記録する
+    # execute_sql のシグネチャは peewee のバージョンで異なるので、
+    # requirements.txt で固定しているバージョンに合わせている
+    def execute_sql(self, sql, params=None):
+        with metrics.timer("db.query"):
+            return super().execute_sql(sql, params)
+
+
+# 接続はスレッドごとに確保され、close するとプールに戻されて再利用される
+# ローカルで実行する場合は .env で DB_HOST などをローカルの Postgres に向ける
+db = InstrumentedPostgresqlDatabase(
     os.environ["DB_NAME"],
     user=os.environ["DB_USER"],
     password=os.environ["DB_PASSWORD"],
     host=os.environ["DB_HOST"],
     port=os.environ["DB_PORT"],
+    # 同時に使える接続数の上限 (クローラーと s3_writer のスレッド数より多くする)
+    max_connections=int(os.environ.get("DB_MAX_CONNECTIONS", "32")),
+    # この秒数より長く使われていない接続は破棄して接続し直す
+    stale_timeout=int(os.environ.get("DB_STALE_TIMEOUT_SECONDS", "300")),
+    # 接続が上限に達している時に空くのを待つ秒数
+    timeout=int(os.environ.get("DB_POOL_TIMEOUT_SECONDS", "30")),
 )
 
 
@@ -20,7 +44,7 @@ class BaseModel(Model):
 class File(BaseModel):
     id = BigIntegerField(primary_key=True)
     name = CharField()
-    parent_id = CharField(null=True)
+    parent_id = BigIntegerField(null=True, index=True)
     owner_type = CharField()
     owner_name = CharField()
     created_at = DateTimeField()
@@ -29,20 +53,332 @@ class File(BaseModel):
     is_deleted = BooleanField()
     file_needs_update = BooleanField()
     metadata_needs_update = BooleanField()
+    # 差分クロールで変更の有無を判定するための値
+    etag = CharField(null=True)
+    sequence_id = CharField(null=True)
+    # Box 上の現在のバージョンの内容の SHA1 とバージョンの ID
+    sha1 = CharField(null=True)
+    version_id = CharField(null=True)
+    # S3 にアップロード済みの内容の SHA1
+    uploaded_sha1 = CharField(null=True)
+    # S3 にアップロード済みのメタデータのハッシュ
+    metadata_hash = CharField(null=True)
+    # S3 への書き込みのために確保されている期限 (UTC)
+    claimed_until = DateTimeField(null=True)
 
 
 class Folder(BaseModel):
     id = BigIntegerField(primary_key=True)
     name = CharField()
-    parent_id = CharField(null=True)
+    parent_id = BigIntegerField(null=True, index=True)
     owner_type = CharField()
     owner_name = CharField()
+    # 差分クロールで配下の変更の有無を判定するための値
+    # 配下を全てクロールし終えた時にだけ更新する
+    etag = CharField(null=True)
+    sequence_id = CharField(null=True)
+    content_modified_at = DateTimeField(null=True)
 
 
 class Collaboration(BaseModel):
     id = BigIntegerField(primary_key=True)
-    item_id = BigIntegerField()
+    item_id = BigIntegerField(index=True)
     item_type = CharField()
     accessible_type = CharField()
     accessible_name = CharField()
     status = CharField()
+
+
+class CrawlFrontier(BaseModel):
+    # クロールで一覧を取得するフォルダのページ (クロールの進捗)
+    # クローラーのタスクが確保して処理する
+    folder_id = BigIntegerField()
+    page_offset = IntegerField(default=0)
+    # ページを取得するためのマーカー (最初のページは None)
+    marker = TextField(null=True)
+    # クロールの完了時にフォルダに保存する差分クロール用の値
+    etag = CharField(null=True)
+    sequence_id = CharField(null=True)
+    content_modified_at = DateTimeField(null=True)
+    is_done = BooleanField(default=False)
+    # クローラーのタスクが処理のために確保している期限 (UTC)
+    claimed_until = DateTimeField(null=True)
+
+    class Meta:
+        table_name = "crawl_frontier"
+        indexes = ((("folder_id", "page_offset"), True),)
+
+
+class CrawlRun(BaseModel):
+    # 分散クロールの実行 (同じ CRAWLER_RUN_ID で起動したタスクが 1 つのクロールを分担する)
+    run_id = CharField(primary_key=True)
+    # 全てのページの処理が終わった時刻 (UTC)
+    finished_at = DateTimeField(null=True)
+
+    class Meta:
+        table_name = "crawl_run"
+
+
+# s3_writer がフラグの立っている行を ID 順に確保するための部分インデックス
+File.add_index(File.id, where=File.file_needs_update, name="file_file_needs_update")
+File.add_index(
+    File.id, where=File.metadata_needs_update, name="file_metadata_needs_update"
+)
+# クローラーが未完了のページを確保するための部分インデックス
+CrawlFrontier.add_index(
+    CrawlFrontier.id, where=~CrawlFrontier.is_done, name="crawl_frontier_pending"
+)
+
+
+class FolderAccess(BaseModel):
+    # フォルダの実効的なアクセス権 (祖先のフォルダから継承したものを含む)
+    # ファイルの ACL は親フォルダの行を参照するだけで求められる
+    folder_id = BigIntegerField(index=True)
+    # アクセス権の元になったフォルダ
+    source_folder_id = BigIntegerField()
+    # コラボレーションによるアクセス権の場合はその ID (所有者の場合は None)
+    collaboration_id = BigIntegerField(null=True, index=True)
+    accessible_type = CharField()
+    accessible_name = CharField()
+
+    class Meta:
+        table_name = "folder_access"
+
+
+class FailedEvent(BaseModel):
+    # 処理に失敗したイベント (SQS のメッセージは削除し、ここから再試行する)
+    # 同じアイテムの後続のイベントも順番を保つためにここに移し、ID 順に再試行する
+    payload = TextField()
+    # イベントの対象のアイテムの ID (SQS のメッセージグループと同じ)
+    item_id = CharField(index=True)
+    # 試行した回数 (順番を待っているだけのイベントは 0)
+    attempts = IntegerField(default=1)
+    # 次に再試行する時刻 (UTC)
+    next_attempt_at = DateTimeField(index=True)
+    last_error = TextField(null=True)
+
+    class Meta:
+        table_name = "failed_event"
+
+
+class SchemaVersion(BaseModel):
+    # 適用済みのマイグレーションの数
+    version = IntegerField()
+
+    class Meta:
+        table_name = "schema_version"
+
+
+MODELS = [
+    File,
+    Folder,
+    Collaboration,
+    CrawlFrontier,
+    CrawlRun,
+    FolderAccess,
+    FailedEvent,
+]
+
+_FOLDER_ACCESS_COLUMNS = (
+    "folder_id",
+    "source_folder_id",
+    "collaboration_id",
+    "accessible_type",
+    "accessible_name",
+)
+
+
+def _own_folder_access(folder_id: Optional[int] = None) -> Select:
+    # フォルダ自身の所有者とコラボレーションによるアクセス権
+    owners = Folder.select(
+        Folder.id,
+        Folder.id,
+        Value(None),
+        fn.UPPER(Folder.owner_type),
+        Folder.owner_name,
+    )
+    collaborations = Collaboration.select(
+        Collaboration.item_id,
+        Collaboration.item_id,
+        Collaboration.id,
+        Collaboration.accessible_type,
+        Collaboration.accessible_name,
+    ).where(Collaboration.item_type == "folder")
+    if folder_id is not None:
+        owners = owners.where(Folder.id == folder_id)
+        collaborations = collaborations.where(Collaboration.item_id == folder_id)
+    return owners.union_all(collaborations)
+
+
+def _subtree(folder_id: int) -> CTE:
+    # フォルダ自身と、アクセス権を継承している配下の全フォルダ
+    # ルートフォルダは親フォルダのアクセス権を継承しない
+    base = Folder.select(Folder.id).where(Folder.id == folder_id).cte(
+        "subtree", recursive=True
+    )
+    child = Folder.alias()
+    recursive = (
+        child.select(child.id)
+        .join(base, on=(child.parent_id == base.c.id))
+        .where(child.id.not_in(config.BOX_ROOT_FOLDER_IDS))
+    )
+    return base.union_all(recursive)
+
+
+def rebuild_folder_access() -> None:
+    # 全てのフォルダのアクセス権をフォルダとコラボレーションから作成し直す
+    effective = _own_folder_access().cte(
+        "effective", recursive=True, columns=_FOLDER_ACCESS_COLUMNS
+    )
+    child = Folder.alias()
+    recursive = (
+        child.select(
+            child.id,
+            effective.c.source_folder_id,
+            effective.c.collaboration_id,
+            effective.c.accessible_type,
+            effective.c.accessible_name,
+        )
+        .join(effective, on=(child.parent_id == effective.c.folder_id))
+        .where(child.id.not_in(config.BOX_ROOT_FOLDER_IDS))
+    )
+    effective = effective.union(recursive)
+
+    with db.atomic():
+        FolderAccess.delete().execute()
+        FolderAccess.insert_from(
+            effective.select_from(
+                *[getattr(effective.c, column) for column in _FOLDER_ACCESS_COLUMNS]
+            ),
+            _FOLDER_ACCESS_COLUMNS,
+        ).execute()
+
+
+def update_folder_access(folder_id: int, parent_id: Optional[int]) -> None:
+    # 作成されたフォルダのアクセス権を、自身と親フォルダのアクセス権から作成する
+    FolderAccess.delete().where(FolderAccess.folder_id == folder_id).execute()
+    FolderAccess.insert_from(
+        _own_folder_access(folder_id), _FOLDER_ACCESS_COLUMNS
+    ).execute()
+    if parent_id is not None and folder_id not in config.BOX_ROOT_FOLDER_IDS:
+        _inherit_folder_access(_subtree(folder_id), parent_id)
+
+
+def move_folder_access(folder_id: int, parent_id: Optional[int]) -> None:
+    # 移動したフォルダの配下から移動前の祖先のアクセス権を取り除き、移動先の親のものを継承する
+    subtree = _subtree(folder_id)
+    FolderAccess.delete().where(
+        FolderAccess.folder_id.in_(subtree.select_from(subtree.c.id))
+        & FolderAccess.source_folder_id.not_in(subtree.select_from(subtree.c.id))
+    ).execute()
+    if parent_id is not None and folder_id not in config.BOX_ROOT_FOLDER_IDS:
+        _inherit_folder_access(subtree, parent_id)
+
+
+def _inherit_folder_access(subtree: CTE, parent_id: int) -> None:
+    parent = FolderAccess.alias()
+    FolderAccess.insert_from(
+        parent.select(
+            subtree.c.id,
+            parent.source_folder_id,
+            parent.collaboration_id,
+            parent.accessible_type,
+            parent.accessible_name,
+        )
+        .join(subtree, JOIN.CROSS)
+        .where(parent.folder_id == parent_id)
+        .with_cte(subtree),
+        _FOLDER_ACCESS_COLUMNS,
+    ).execute()
+
+
+def grant_collaboration_access(collaboration: dict) -> None:
+    # フォルダのコラボレーションのアクセス権を配下の全フォルダに追加する
+    revoke_collaboration_access(int(collaboration["id"]))
+    subtree = _subtree(int(collaboration["item_id"]))
+    FolderAccess.insert_from(
+        subtree.select_from(
+            subtree.c.id,
+            Value(int(collaboration["item_id"])),
+            Value(int(collaboration["id"])),
+            Value(collaboration["accessible_type"]),
+            Value(collaboration["accessible_name"]),
+        ),
+        _FOLDER_ACCESS_COLUMNS,
+    ).execute()
+
+
+def revoke_collaboration_access(collaboration_id: int) -> None:
+    FolderAccess.delete().where(
+        FolderAccess.collaboration_id == collaboration_id
+    ).execute()
+
+
+def _migrate_from_first_release(migrator: PostgresqlMigrator) -> None:
+    # 最初のリリースのテーブル (file, folder, collaboration) を最新の定義にする
+    migrate(
+        *[
+            migrator.add_column("file", name, File._meta.fields[name])
+            for name in (
+                "etag",
+                "sequence_id",
+                "sha1",
+                "version_id",
+                "uploaded_sha1",
+                "metadata_hash",
+                "claimed_until",
+            )
+        ],
+        *[
+            migrator.add_column("folder", name, Folder._meta.fields[name])
+            for name in ("etag", "sequence_id", "content_modified_at")
+        ],
+    )
+    # parent_id を ID と同じ型にして、検索に使うカラムにインデックスを作成する
+    for model in (File, Folder):
+        migrate(
+            migrator.alter_column_type(
+                model._meta.table_name,
+                "parent_id",
+                model.parent_id,
+                cast=SQL("parent_id::bigint"),
+            )
+        )
+    for model in (File, Folder, Collaboration):
+        model._schema.create_indexes(safe=True)
+
+    db.create_tables([CrawlFrontier, CrawlRun, FolderAccess, FailedEvent])
+    rebuild_folder_access()
+
+
+# 既存の環境のテーブルを更新するマイグレーション
+# 追加する時は末尾に追加し、適用済みのものは変更しない
+MIGRATIONS = [_migrate_from_first_release]
+
+# 同時に起動したタスクが重複してマイグレーションしないように取るロックの ID
+_MIGRATION_LOCK_ID = 20240601
+
+
+def create_tables() -> None:
+    # テーブルを作成し、未適用のマイグレーションを順番に適用する
+    # DDL もトランザクションに含まれるので、途中で失敗した場合は全て元に戻る
+    with db.atomic():
+        db.execute_sql("SELECT pg_advisory_xact_lock(%s)", (_MIGRATION_LOCK_ID,))
+        db.create_tables([SchemaVersion])
+
+        schema_version = SchemaVersion.select().first()
+        if schema_version is None:
+            # バージョンが記録されていない場合は、最初のリリースのテーブルがあれば
+            # 全てのマイグレーションを適用し、なければ最新のテーブルを作成する
+            if File.table_exists():
+                schema_version = SchemaVersion.create(version=0)
+            else:
+                db.create_tables(MODELS)
+                schema_version = SchemaVersion.create(version=len(MIGRATIONS))
+
+        migrator = PostgresqlMigrator(db)
+        for migration in MIGRATIONS[schema_version.version :]:
+            migration(migrator)
+
+        schema_version.version = len(MIGRATIONS)
+        schema_version.save()
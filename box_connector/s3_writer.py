@@ -1,46 +1,594 @@
+import hashlib
 import json
 import logging
+import os
+import threading
+import traceback
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from queue import Full, Queue
+from typing import BinaryIO, Callable, Iterator, Optional
 
 import boto3
+from peewee import Field
 
 import config
 from box import box_client
-from models import File, Folder, Collaboration
+from metrics import metrics
+from models import db, File, Collaboration, FolderAccess
 import utils
 
 
 logger = logging.getLogger("s3_writer")
 s3_client = boto3.client("s3")
+metrics.instrument_boto3_client(s3_client, "s3")
+
+# ステージのスレッドを終了させるための番兵
+_STOP = object()
+# 内容が変わっていないのでアップロードしないファイルに付ける番兵
+_UNCHANGED = object()
+# Box のストリームから 1 回に読み出すサイズ
+_READ_SIZE = 64 * 1024
+# ダウンロードのキャッシュに書き込み中のファイルの接頭辞
+_TEMPORARY_PREFIX = ".tmp-"
+# 次のステージのスレッドが止まっていないか確認する間隔 (秒)
+_PUT_TIMEOUT_SECONDS = 1
+
+
+class DownloadCache:
+    # Box からダウンロードした内容をファイルの ID・バージョン・SHA1 ごとにディスクに保存する
+    # 合計サイズが max_bytes を超えたら、最後に使われたのが古いものから削除する
+    # 使われた順番はファイルの更新時刻に記録するので、プロセスを起動し直しても引き継がれる
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for path in self.directory.iterdir():
+            if path.name.startswith(_TEMPORARY_PREFIX):
+                # 前回の実行で書き込みの途中だったファイル
+                path.unlink(missing_ok=True)
+                continue
+            stat = path.stat()
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+        with self._lock:
+            for _, key, size in sorted(entries):
+                self._entries[key] = size
+                self._total_bytes += size
+            self._evict()
+
+    def open(self, file: File) -> Optional[BinaryIO]:
+        key = self._key(file)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+
+        try:
+            stream = (self.directory / key).open("rb")
+        except FileNotFoundError:
+            # 他のスレッドが削除した
+            return None
+        try:
+            # 開いたファイルの更新時刻を更新するので、開いた後に削除されても失敗しない
+            os.utime(stream.fileno())
+        except OSError:
+            stream.close()
+            return None
+        return stream
+
+    def wrap(self, file: File, stream: BinaryIO) -> BinaryIO:
+        # 読み出した内容をキャッシュに書き込みながら返すストリームにする
+        key = self._key(file)
+        if key is None:
+            return stream
+        return _CachingStream(stream, self, key, file.sha1)
+
+    def add(self, key: str, temporary: Path, size: int) -> None:
+        if size > self.max_bytes:
+            temporary.unlink(missing_ok=True)
+            return
+
+        temporary.replace(self.directory / key)
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            (self.directory / key).unlink(missing_ok=True)
+
+    @staticmethod
+    def _key(file: File) -> Optional[str]:
+        # 内容を確認できない SHA1 のないファイルはキャッシュしない
+        if file.sha1 is None:
+            return None
+        return f"{file.id}-{file.version_id or ''}-{file.sha1}"
+
+
+class _CachingStream:
+    # 読み出した内容を一時ファイルにも書き込み、閉じる時に SHA1 が一致すれば
+    # (最後まで読み出していれば) キャッシュに追加する
+    # アップロードに失敗しても、最後まで読み出していれば再実行でキャッシュを使える
+    def __init__(
+        self, stream: BinaryIO, cache: DownloadCache, key: str, sha1: str
+    ) -> None:
+        self._stream = stream
+        self._cache = cache
+        self._key = key
+        self._sha1 = sha1
+        self._hash = hashlib.sha1()
+        self._size = 0
+        self._temporary = cache.directory / f"{_TEMPORARY_PREFIX}{uuid.uuid4().hex}"
+        self._file = self._temporary.open("wb")
+
+    def read(self, size: int = -1) -> bytes:
+        buffer = self._stream.read(size)
+        if self._file is not None:
+            try:
+                self._file.write(buffer)
+            except OSError as e:
+                # ディスクに書き込めなくてもアップロードは続ける
+                logger.warning(
+                    {"text": "Error writing download cache", "error": str(e)}
+                )
+                self._discard()
+                return buffer
+            self._hash.update(buffer)
+            self._size += len(buffer)
+        return buffer
+
+    def close(self) -> None:
+        if self._file is not None:
+            if self._hash.hexdigest() == self._sha1:
+                self._file.close()
+                self._file = None
+                self._cache.add(self._key, self._temporary, self._size)
+            else:
+                self._discard()
+        self._stream.close()
+
+    def _discard(self) -> None:
+        self._file.close()
+        self._file = None
+        self._temporary.unlink(missing_ok=True)
+
+
+# WRITER_DOWNLOAD_CACHE_DIR が設定されていなければキャッシュしない
+download_cache = (
+    DownloadCache(
+        config.WRITER_DOWNLOAD_CACHE_DIR, config.WRITER_DOWNLOAD_CACHE_MAX_BYTES
+    )
+    if config.WRITER_DOWNLOAD_CACHE_DIR
+    else None
+)
 
 
 def write_files() -> None:
-    for file in File.select().where(File.file_needs_update):
-        if file.is_trashed:
-            _delete_file_and_metadata(file)
-            file.file_needs_update = False
-            file.metadata_needs_update = False
-            file.save()
-        if file.is_deleted:
-            file.delete()
-        else:
-            _save_file(file)
-            file.file_needs_update = False
-            file.save()
-
-    for file in File.select().where(File.metadata_needs_update):
-        _save_metadata(file)
-        file.metadata_needs_update = False
-        file.save()
-
-
-def _save_file(file: File) -> None:
-    file_content = box_client.downloads.download_file(file.id).read()
+    _write_file_contents()
+
+    counts = Counter()
+    resolver = AccessControlListResolver()
+    for files in _claim_chunks(File.metadata_needs_update, config.WRITER_BATCH_SIZE):
+        with metrics.timer("acl.load"):
+            resolver.load(files)
+        for file in files:
+            counts["uploaded" if _save_metadata(file, resolver) else "skipped"] += 1
+
+        # チャンクごとに 1 つのトランザクションで DB に反映する
+        with metrics.timer("writer.commit_metadata"), db.atomic():
+            for file in files:
+                File.update(
+                    metadata_hash=file.metadata_hash,
+                    metadata_needs_update=False,
+                    claimed_until=None,
+                ).where(_is_claimed(file)).execute()
+
+    for result, count in counts.items():
+        metrics.increment(f"writer.metadata_{result}", count)
+    logger.info({"text": "Metadata have been written", **counts})
+
+
+def _write_file_contents() -> None:
+    # Box からのダウンロード → S3 へのアップロード → DB の更新 をそれぞれ別のスレッドで実行する
+    download_queue = Queue(maxsize=config.WRITER_QUEUE_SIZE)
+    upload_queue = Queue(maxsize=config.WRITER_QUEUE_SIZE)
+    commit_queue = Queue(maxsize=config.WRITER_QUEUE_SIZE)
+
+    # 後ろのステージから起動し、前のステージに渡す先のスレッドを教える
+    counts = Counter()
+    committers = [
+        threading.Thread(
+            target=_run_committer, args=(commit_queue, counts), daemon=True
+        )
+    ]
+    committers[0].start()
+    uploaders = _start_stage(
+        _upload_file,
+        upload_queue,
+        commit_queue,
+        committers,
+        config.WRITER_UPLOAD_WORKERS,
+    )
+    downloaders = _start_stage(
+        _download_file,
+        download_queue,
+        upload_queue,
+        uploaders,
+        config.WRITER_DOWNLOAD_WORKERS,
+    )
+
+    # 確保に失敗しても各ステージを止めてから例外を投げる
+    try:
+        for files in _claim_chunks(
+            File.file_needs_update, config.WRITER_FILE_CLAIM_SIZE
+        ):
+            for file in files:
+                _put(download_queue, file, downloaders)
+    finally:
+        _stop_stage(download_queue, downloaders)
+        _stop_stage(upload_queue, uploaders)
+        _stop_stage(commit_queue, committers)
+
+    for result, count in counts.items():
+        metrics.increment(f"writer.files_{result}", count)
+    logger.info({"text": "Files have been written", **counts})
+
+
+def _claim_chunks(flag: Field, batch_size: int) -> Iterator[list[File]]:
+    # フラグの立っている行を ID 順に batch_size 件ずつ確保して返す
+    # 確保した行は WRITER_CLAIM_TIMEOUT_SECONDS の間は他のプロセスから処理されない
+    # 処理が終わった行はフラグを下ろすので、途中で止まっても残りの行から再開できる
+    # 次のチャンクは前のチャンクを渡し終えてから確保するので、
+    # 確保してから処理し終わるまでの時間は batch_size 件分に収まる
+    last_id = 0
+
+    while True:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        candidate = File.alias()
+        candidates = (
+            candidate.select(candidate.id)
+            .where(
+                getattr(candidate, flag.name)
+                & (candidate.id > last_id)
+                & (
+                    candidate.claimed_until.is_null()
+                    | (candidate.claimed_until < now)
+                )
+            )
+            .order_by(candidate.id)
+            .limit(batch_size)
+            .for_update("FOR UPDATE SKIP LOCKED")
+        )
+        with db.atomic():
+            files = list(
+                File.update(
+                    claimed_until=now
+                    + timedelta(seconds=config.WRITER_CLAIM_TIMEOUT_SECONDS)
+                )
+                .where(File.id.in_(candidates))
+                .returning(File)
+                .execute()
+            )
+
+        if not files:
+            return
+
+        files.sort(key=lambda file: file.id)
+        yield files
+        last_id = files[-1].id
+
+
+def _start_stage(
+    function: Callable,
+    in_queue: Queue,
+    out_queue: Queue,
+    consumers: list[threading.Thread],
+    workers: int,
+) -> list[threading.Thread]:
+    name = getattr(function, "__name__", str(function))
+    timer_name = "writer." + name.lstrip("_")
+
+    def run() -> None:
+        while True:
+            item = in_queue.get()
+            if item is _STOP:
+                break
+            try:
+                with metrics.timer(timer_name):
+                    result = function(item)
+            except Exception as e:
+                # 失敗したファイルはフラグが残るので次回の実行で再処理される
+                metrics.increment("writer.files_failed")
+                logger.error(
+                    {
+                        "text": "Error writing file",
+                        "stage": name,
+                        "error": str(e),
+                        "traceback": traceback.format_exc(),
+                    }
+                )
+                continue
+            # 次のステージが止まっていたらこのステージも止まり、前のステージに伝える
+            _put(out_queue, result, consumers)
+
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _put(queue: Queue, item, consumers: list[threading.Thread]) -> None:
+    # キューが空くのを待つ間に、受け取るスレッドが全て止まっていたら例外を投げる
+    # 待ち続けると write_files が終わらなくなるため
+    while True:
+        try:
+            queue.put(item, timeout=_PUT_TIMEOUT_SECONDS)
+            return
+        except Full:
+            if not any(thread.is_alive() for thread in consumers):
+                raise RuntimeError("Writer stage has stopped unexpectedly")
+
+
+def _stop_stage(in_queue: Queue, threads: list[threading.Thread]) -> None:
+    for _ in threads:
+        try:
+            _put(in_queue, _STOP, threads)
+        except RuntimeError:
+            # 止まっているスレッドに番兵を送る必要はない
+            break
+    for thread in threads:
+        thread.join()
+
+
+def _download_file(file: File) -> tuple[File, BinaryIO]:
+    # アップロードしないファイルはストリームの代わりに _UNCHANGED を返す
+    if file.is_trashed or file.is_deleted or _is_uploaded(file):
+        return file, _UNCHANGED
+
+    if download_cache is None:
+        # 中身はアップロードのステージで少しずつ読み出す
+        return file, _download_from_box(file)
+
+    stream = download_cache.open(file)
+    if stream is not None:
+        metrics.increment("writer.download_cache_hits")
+        return file, stream
+    metrics.increment("writer.download_cache_misses")
+    return file, download_cache.wrap(file, _download_from_box(file))
+
+
+def _download_from_box(file: File) -> BinaryIO:
+    stream = box_client.downloads.download_file(file.id)
+    if stream is None:
+        # Box がダウンロードの準備を終えていない (HTTP 202 を返し続けた)
+        # フラグを残して次回の実行で再処理する
+        raise RuntimeError(f"File {file.id} is not ready to download from Box")
+    return stream
+
+
+def _upload_file(job: tuple[File, BinaryIO]) -> tuple[File, str]:
+    file, stream = job
+    if file.is_trashed or file.is_deleted:
+        _delete_file_and_metadata(file)
+        return file, "deleted"
+
+    # 内容が変わっていなければアップロードせずにメタデータだけ更新する
+    if stream is _UNCHANGED:
+        return file, "skipped"
+
     key = config.S3_DOCUMENT_KEY_PREFIX + str(file.id)
-    s3_client.put_object(Bucket=config.BUCKET_NAME, Key=key, Body=file_content)
+    try:
+        _stream_to_s3(stream, key)
+    finally:
+        stream.close()
     logger.info(f"Upload file to s3://{config.BUCKET_NAME}/{key}")
+    return file, "uploaded"
+
+
+def _is_uploaded(file: File) -> bool:
+    return file.sha1 is not None and file.sha1 == file.uploaded_sha1
+
+
+def _stream_to_s3(stream: BinaryIO, key: str) -> None:
+    # パートサイズごとに読み出してマルチパートアップロードする
+    # 読み出したサイズがパートサイズより小さければ最後のパートとみなす
+    part_size = config.S3_MULTIPART_PART_SIZE
+    chunk = _read_part(stream, part_size)
+
+    if len(chunk) < part_size:
+        s3_client.put_object(Bucket=config.BUCKET_NAME, Key=key, Body=chunk)
+        return
+
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=config.BUCKET_NAME, Key=key
+    )["UploadId"]
+
+    try:
+        parts = []
+        while chunk:
+            part_number = len(parts) + 1
+            res = s3_client.upload_part(
+                Bucket=config.BUCKET_NAME,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=chunk,
+            )
+            parts.append({"ETag": res["ETag"], "PartNumber": part_number})
+
+            if len(chunk) < part_size:
+                break
+            chunk = _read_part(stream, part_size)
+
+        s3_client.complete_multipart_upload(
+            Bucket=config.BUCKET_NAME,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(
+            Bucket=config.BUCKET_NAME, Key=key, UploadId=upload_id
+        )
+        raise
+
+
+def _read_part(stream: BinaryIO, size: int) -> bytes:
+    # Box SDK のストリームは 1 回の read で読み出すサイズが大きいほどコピーが増えるので
+    # 小さく分けて読み出す
+    buffers = []
+    remaining = size
+    while remaining > 0:
+        read_size = min(remaining, _READ_SIZE)
+        buffer = stream.read(read_size)
+        buffers.append(buffer)
+        remaining -= len(buffer)
+        # 要求したサイズより短ければストリームの終わり
+        if len(buffer) < read_size:
+            break
+    return b"".join(buffers)
+
+
+def _run_committer(commit_queue: Queue, counts: Counter) -> None:
+    # 溜まっている結果を WRITER_COMMIT_BATCH_SIZE 件ずつ 1 つのトランザクションで反映する
+    with db.connection_context():
+        stopped = False
+        while not stopped:
+            jobs = [commit_queue.get()]
+            while (
+                len(jobs) < config.WRITER_COMMIT_BATCH_SIZE
+                and not commit_queue.empty()
+            ):
+                jobs.append(commit_queue.get())
+            if jobs[-1] is _STOP:
+                jobs.pop()
+                stopped = True
+
+            committed = Counter()
+            try:
+                with metrics.timer("writer.commit_files"), db.atomic():
+                    for job in jobs:
+                        try:
+                            # 失敗したファイルだけロールバックする
+                            with db.atomic():
+                                _commit_file(job)
+                            committed[job[1]] += 1
+                        except Exception as e:
+                            # 失敗したファイルはフラグが残るので次回の実行で再処理される
+                            metrics.increment("writer.files_failed")
+                            _log_commit_error(e)
+            except Exception as e:
+                # トランザクションごと失敗した場合もスレッドは止めずに次の結果を反映する
+                # このトランザクションのファイルはフラグが残るので次回の実行で再処理される
+                metrics.increment("writer.files_failed", sum(committed.values()))
+                _log_commit_error(e)
+                continue
+            counts.update(committed)
+
+
+def _log_commit_error(e: Exception) -> None:
+    logger.error(
+        {
+            "text": "Error writing file",
+            "stage": "_commit_file",
+            "error": str(e),
+            "traceback": traceback.format_exc(),
+        }
+    )
+
 
+def _commit_file(job: tuple[File, str]) -> None:
+    # 処理した列だけを更新する
+    # 処理中に Webhook で更新された行は確保が外れているので更新せず、
+    # フラグを残して次回の実行で再処理する
+    file, result = job
+    claimed = _is_claimed(file) & (File.sha1 == file.sha1)
 
-def _save_metadata(file: File) -> None:
+    if file.is_deleted:
+        File.delete().where(claimed).execute()
+    elif file.is_trashed:
+        File.update(
+            file_needs_update=False,
+            metadata_needs_update=False,
+            uploaded_sha1=None,
+            metadata_hash=None,
+            claimed_until=None,
+        ).where(claimed).execute()
+    else:
+        File.update(
+            file_needs_update=False, uploaded_sha1=file.sha1, claimed_until=None
+        ).where(claimed).execute()
+
+
+def _is_claimed(file: File):
+    # _claim_chunks で確保してから他に更新されていなければ真になる条件
+    return (File.id == file.id) & (File.claimed_until == file.claimed_until)
+
+
+class AccessControlListResolver:
+    # ファイルの ACL を、ファイルのコラボレーションと親フォルダの folder_access から求める
+    # どちらもチャンクごとに 1 回のクエリで読み込み、フォルダの ACL はメモ化する
+    def __init__(self) -> None:
+        self._file_collaborations = defaultdict(list)
+        self._folder_acls = {}
+
+    def load(self, files: list[File]) -> None:
+        self._file_collaborations = defaultdict(list)
+        for item_id, accessible_type, accessible_name in (
+            Collaboration.select(
+                Collaboration.item_id,
+                Collaboration.accessible_type,
+                Collaboration.accessible_name,
+            )
+            .where(
+                (Collaboration.item_type == "file")
+                & (Collaboration.item_id.in_([file.id for file in files]))
+            )
+            .tuples()
+        ):
+            self._file_collaborations[item_id].append(
+                _allow(accessible_name, accessible_type)
+            )
+
+        folder_ids = {file.parent_id for file in files} - self._folder_acls.keys()
+        folder_acls = defaultdict(list)
+        for folder_id, accessible_type, accessible_name in (
+            FolderAccess.select(
+                FolderAccess.folder_id,
+                FolderAccess.accessible_type,
+                FolderAccess.accessible_name,
+            )
+            .where(FolderAccess.folder_id.in_(list(folder_ids)))
+            .tuples()
+        ):
+            folder_acls[folder_id].append(_allow(accessible_name, accessible_type))
+        for folder_id in folder_ids:
+            self._folder_acls[folder_id] = _remove_duplicates(folder_acls[folder_id])
+
+    def get_access_control_list(self, file: File) -> list[dict]:
+        access_control_list = [_allow(file.owner_name, file.owner_type.upper())]
+        access_control_list += self._file_collaborations[file.id]
+        access_control_list += self._folder_acls.get(file.parent_id, [])
+        return _remove_duplicates(access_control_list)
+
+
+def _allow(name: str, type: str) -> dict:
+    return {"Name": name, "Type": type, "Access": "ALLOW"}
+
+
+def _save_metadata(file: File, resolver: AccessControlListResolver) -> bool:
+    # 前回アップロードした内容と同じであればアップロードせずに False を返す
+    # アップロードすると Kendra の再同期の対象になるため
     data = {
         "DocumentId": str(file.id),
         "Attributes": {
@@ -50,8 +598,15 @@ def _save_metadata(file: File) -> None:
         },
         "Title": file.name,
         "ContentType": _get_document_type(file.name),
-        "AccessControlList": _get_access_control_list(file),
     }
+    with metrics.timer("acl.resolve"):
+        data["AccessControlList"] = resolver.get_access_control_list(file)
+    metadata_hash = hashlib.sha256(
+        json.dumps(data, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    if metadata_hash == file.metadata_hash:
+        return False
+
     key = config.S3_DOCUMENT_KEY_PREFIX + str(file.id) + config.METADATA_FILE_SUFFIX
     s3_client.put_object(
         Bucket=config.BUCKET_NAME,
@@ -59,6 +614,8 @@ def _save_metadata(file: File) -> None:
         Body=json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"),
     )
     logger.info(f"Upload metadata to s3://{config.BUCKET_NAME}/{key}")
+    file.metadata_hash = metadata_hash
+    return True
 
 
 def _delete_file_and_metadata(file: File) -> None:
@@ -72,56 +629,9 @@ def _delete_file_and_metadata(file: File) -> None:
 
 
 def _remove_duplicates(list_of_dicts: list[dict]) -> list[dict]:
+    # 内容が同じなら同じ JSON になるように並べ替える
     unique_dicts = {json.dumps(d, sort_keys=True) for d in list_of_dicts}
-    return [json.loads(d) for d in unique_dicts]
-
-
-def _get_access_control_list(file: File) -> list[dict]:
-    access_control_list = [
-        {"Name": file.owner_name, "Type": file.owner_type.upper(), "Access": "ALLOW"}
-    ]
-
-    for collaboration in Collaboration.select().where(Collaboration.item_id == file.id):
-        access_control_list.append(
-            {
-                "Name": collaboration.accessible_name,
-                "Type": collaboration.accessible_type,
-                "Access": "ALLOW",
-            }
-        )
-
-    current_folder_id = file.parent_id
-
-    while True:
-        folder = Folder.get_or_none(Folder.id == current_folder_id)
-        if not folder:
-            break
-
-        access_control_list.append(
-            {
-                "Name": folder.owner_name,
-                "Type": folder.owner_type.upper(),
-                "Access": "ALLOW",
-            }
-        )
-
-        for collaboration in Collaboration.select().where(
-            Collaboration.item_id == current_folder_id
-        ):
-            access_control_list.append(
-                {
-                    "Name": collaboration.accessible_name,
-                    "Type": collaboration.accessible_type,
-                    "Access": "ALLOW",
-                }
-            )
-
-        if current_folder_id in config.BOX_ROOT_FOLDER_IDS:
-            break
-
-        current_folder_id = folder.parent_id
-
-    return _remove_duplicates(access_control_list)
+    return [json.loads(d) for d in sorted(unique_dicts)]
 
 
 def _get_document_type(name: str) -> str:
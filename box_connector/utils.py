@@ -1,5 +1,8 @@
+from datetime import datetime, timezone
 from typing import Optional
 
+from dateutil import parser
+
 import config
 
 
@@ -18,3 +21,8 @@ def is_support_file(name: str) -> bool:
         return False
 
 
+def to_utc(value: Optional[str]) -> Optional[datetime]:
+    # DB には UTC の naive な datetime として保存する
+    if not value:
+        return
+    return parser.parse(value).astimezone(timezone.utc).replace(tzinfo=None)
@@ -63,9 +63,17 @@ export class BoxConnector extends Construct {
         requestParameters: {
           'integration.request.header.Content-Type': `'application/x-www-form-urlencoded'`,
         },
+        // メッセージグループを Box のアイテムの ID ごとに分けて、
+        // 同じアイテムのイベントの順番を保ったまま複数のグループを並列に受信できるようにする
+        // ID が含まれないリクエストは従来どおり 1 つのグループにまとめる
         requestTemplates: {
-          'application/json':
-            'Action=SendMessage&MessageGroupId=Box&MessageBody=$input.body',
+          'application/json': [
+            "#set($groupId = $input.path('$.source.id'))",
+            '#if("$!groupId" == "")#set($groupId = "Box")#end',
+            'Action=SendMessage',
+            '&MessageGroupId=$util.urlEncode($groupId)',
+            '&MessageBody=$input.body',
+          ].join(''),
         },
         integrationResponses: [
           {
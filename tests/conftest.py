@@ -11,6 +11,30 @@ from moto import mock_aws
 sys.path.append(str((Path(__file__).parent.parent / "box_connector").resolve()))
 
 
+# テストで空にしてよい DB のホスト (ソケットのディレクトリも含む)
+LOCAL_DB_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+@pytest.fixture(autouse=True)
+def clean_database():
+    import models
+
+    # ローカル以外の DB は TEST_ALLOW_REMOTE_DB=True を指定した場合だけ空にする
+    db_host = os.environ.get("DB_HOST", "")
+    if not (db_host in LOCAL_DB_HOSTS or db_host.startswith("/")):
+        if os.environ.get("TEST_ALLOW_REMOTE_DB", "").lower() != "true":
+            pytest.exit(
+                f"DB_HOST={db_host!r} is not a local Postgres."
+                " The tests truncate all tables; set TEST_ALLOW_REMOTE_DB=True to run."
+            )
+
+    # テストごとに DB を空にする
+    models.create_tables()
+    models.db.execute_sql(
+        "TRUNCATE " + ", ".join(model._meta.table_name for model in models.MODELS)
+    )
+
+
 @pytest.fixture(autouse=True)
 def mock_box_client(mocker: MockFixture):
     mock_file = mocker.Mock()
@@ -0,0 +1,22 @@
+import time
+
+from box_connector import box
+
+
+def test_get_endpoint():
+    assert (
+        box._get_endpoint("GET", "https://api.box.com/2.0/folders/12345/items?limit=1")
+        == "GET /2.0/folders/{id}/items"
+    )
+
+
+def test_rate_limiter_throttle():
+    rate_limiter = box.RateLimiter(rate=100, burst=1)
+
+    rate_limiter.throttle(0.2)
+
+    # 429 が返ってきたら Retry-After の間は待機し、レートを下げる
+    started_at = time.monotonic()
+    rate_limiter.acquire()
+    assert time.monotonic() - started_at >= 0.2
+    assert rate_limiter.rate == 50
@@ -0,0 +1,172 @@
+import time
+
+import box_sdk_gen
+import pytest
+from pytest_mock import MockFixture
+
+from box_connector import box_crawler
+from box_connector.models import (
+    create_tables,
+    CrawlFrontier,
+    CrawlRun,
+    File,
+    Folder,
+    FolderAccess,
+)
+
+OWNER = {"type": "user", "id": "1", "login": "test-user1@example.com"}
+
+
+def _folder(folder_id: str, parent_id: str) -> dict:
+    return {
+        "type": "folder",
+        "id": folder_id,
+        "name": f"folder-{folder_id}",
+        "parent": {"type": "folder", "id": parent_id},
+        "owned_by": OWNER,
+        "etag": "0",
+    }
+
+
+def _file(file_id: str, parent_id: str, name: str, **fields) -> dict:
+    return {
+        **fields,
+        "type": "file",
+        "id": file_id,
+        "name": name,
+        "parent": {"type": "folder", "id": parent_id},
+        "owned_by": OWNER,
+        "created_at": "2012-12-12T10:53:43-08:00",
+        "modified_at": "2012-12-12T10:53:43-08:00",
+        "etag": "0",
+    }
+
+
+TREE = {
+    "400": [
+        box_sdk_gen.schemas.FolderMini.from_dict(_folder("401", "400")),
+        box_sdk_gen.schemas.FileFull.from_dict(_file("4000", "400", "a.txt")),
+        box_sdk_gen.schemas.FileFull.from_dict(_file("4001", "400", "a.exe")),
+    ],
+    "401": [
+        box_sdk_gen.schemas.FileFull.from_dict(
+            _file("4010", "401", "b.pdf", has_collaborations=False)
+        ),
+    ],
+}
+
+
+@pytest.fixture
+def short_poll_interval(mocker: MockFixture):
+    # 分散クロールでは他のタスクが追加したページを DB のポーリングで待つ
+    mocker.patch.object(box_crawler.config, "CRAWLER_POLL_INTERVAL_SECONDS", 0.1)
+
+
+def _mock_box_client(mocker: MockFixture):
+    box_client = mocker.patch("box_connector.box_crawler.box_client")
+
+    def get_folder_items(folder_id, fields, usemarker, marker, limit):
+        entries = TREE.get(folder_id, [])
+        start = int(marker or 0)
+        return mocker.Mock(
+            entries=entries[start : start + limit],
+            next_marker=str(start + limit) if start + limit < len(entries) else None,
+        )
+
+    box_client.folders.get_folder_items.side_effect = get_folder_items
+    box_client.list_collaborations.get_folder_collaborations.return_value.entries = []
+    box_client.list_collaborations.get_file_collaborations.return_value.entries = []
+    return box_client
+
+
+def test_crawl(mocker: MockFixture):
+    create_tables()
+    box_client = _mock_box_client(mocker)
+    root = box_sdk_gen.schemas.FolderFull.from_dict(_folder("400", "0"))
+
+    box_crawler.crawl([root])
+
+    # 対象の拡張子のファイルとフォルダがまとめて書き込まれる
+    assert Folder.select().where(Folder.id.in_([400, 401])).count() == 2
+    assert [f.id for f in File.select().where(File.id >= 4000).order_by(File.id)] == [
+        4000,
+        4010,
+    ]
+    # has_collaborations が False のファイルはコラボレーションを取得しない
+    box_client.list_collaborations.get_file_collaborations.assert_called_once_with(
+        "4000"
+    )
+    counters = box_crawler.metrics.summary()["counters"]
+    assert counters["crawler.collaboration_calls_saved"] >= 1
+
+    # 記録済みのファイルはスキップされる
+    mocker.patch.object(box_crawler.config, "SKIP_EXISTING_ITEMS", True)
+    box_client.list_collaborations.get_file_collaborations.reset_mock()
+
+    box_crawler.crawl([root])
+
+    box_client.list_collaborations.get_file_collaborations.assert_not_called()
+
+
+@pytest.mark.usefixtures("short_poll_interval")
+def test_crawl_distributed(mocker: MockFixture):
+    box_client = _mock_box_client(mocker)
+    mocker.patch.object(box_crawler.config, "CRAWLER_DISTRIBUTED", True)
+    mocker.patch.object(box_crawler.config, "CRAWLER_RUN_ID", "run-1")
+    mocker.patch.object(box_crawler.config, "CRAWLER_PAGE_SIZE", 2)
+    root = box_sdk_gen.schemas.FolderFull.from_dict(_folder("400", "0"))
+
+    box_crawler.crawl([root])
+
+    # 2 ページに分かれたフォルダも全て処理される
+    assert Folder.select().where(Folder.id.in_([400, 401])).count() == 2
+    assert [f.id for f in File.select().order_by(File.id)] == [4000, 4010]
+
+    # 完了したら差分クロール用の値を保存して crawl_frontier を片付ける
+    assert Folder.get_by_id(401).etag == "0"
+    assert FolderAccess.select().where(FolderAccess.folder_id == 401).exists()
+    assert CrawlFrontier.select().count() == 0
+    assert CrawlRun.get_by_id("run-1").finished_at is not None
+
+    # 完了した後に同じ実行のタスクが起動しても新しいクロールは始めない
+    box_client.folders.get_folder_items.reset_mock()
+    box_crawler.crawl([root])
+    box_client.folders.get_folder_items.assert_not_called()
+
+
+def test_keep_claimed(mocker: MockFixture):
+    mocker.patch.object(box_crawler.config, "CRAWLER_CLAIM_TIMEOUT_SECONDS", 0.2)
+    CrawlFrontier.create(folder_id=400)
+    page = box_crawler._claim_frontier_page()
+
+    # 処理している間は確保の期限が延びる
+    with box_crawler._keep_claimed(page):
+        time.sleep(0.5)
+        assert CrawlFrontier.get_by_id(page.id).claimed_until > page.claimed_until
+
+
+def test_crawl_resume(mocker: MockFixture):
+    box_client = _mock_box_client(mocker)
+    get_folder_items = box_client.folders.get_folder_items.side_effect
+    root = box_sdk_gen.schemas.FolderFull.from_dict(_folder("400", "0"))
+
+    # サブフォルダの一覧取得で停止する
+    def fail_in_subfolder(folder_id, **kwargs):
+        if folder_id == "401":
+            raise RuntimeError("network error")
+        return get_folder_items(folder_id, **kwargs)
+
+    box_client.folders.get_folder_items.side_effect = fail_in_subfolder
+    with pytest.raises(RuntimeError):
+        box_crawler.crawl([root])
+
+    # 再開すると完了したページは取得し直さない
+    box_client.folders.get_folder_items.reset_mock()
+    box_client.folders.get_folder_items.side_effect = get_folder_items
+    box_crawler.crawl([root], resume=True)
+
+    assert [
+        call.args[0] for call in box_client.folders.get_folder_items.call_args_list
+    ] == ["401"]
+    assert [f.id for f in File.select().order_by(File.id)] == [4000, 4010]
+    assert CrawlFrontier.select().count() == 0
@@ -1,9 +1,13 @@
+import io
 import os
 import json
+from datetime import datetime
 
 import boto3
+from pytest_mock import MockFixture
 
 from box_connector import event_handler, config
+from box_connector.models import FailedEvent, File, Folder
 
 
 def test_file_uploaded():
@@ -60,3 +64,204 @@ def test_file_uploaded():
             {"Access": "ALLOW", "Name": "test-user1@example.com", "Type": "USER"}
         ],
     }
+
+
+def test_file_uploaded_unchanged_content(mocker: MockFixture):
+    mock_download = mocker.patch("event_handler.box_client.downloads.download_file")
+    mock_download.side_effect = lambda file_id: io.BytesIO(b"test-content")
+    sqs_client = boto3.client("sqs")
+
+    queue_url = sqs_client.get_queue_url(
+        QueueName=os.environ["SQS_QUEUE_NAME"],
+    )["QueueUrl"]
+
+    payload = {
+        "trigger": "FILE.UPLOADED",
+        "source": {
+            "id": "11",
+            "type": "file",
+            "name": "test.txt",
+            "parent": {"id": 100},
+            "created_at": "2012-12-12T10:53:43-08:00",
+            "modified_at": "2012-12-12T10:53:43-08:00",
+            "owned_by": {"type": "user", "login": "test-user1@example.com"},
+            "sha1": "85136c79cbf9fe36bb9d05d0639c70c265c18d37",
+            "file_version": {"id": "110"},
+        },
+    }
+
+    for _ in range(2):
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(payload))
+        event_handler.main()
+
+    # 内容が変わっていないファイルは再ダウンロードされない
+    mock_download.assert_called_once()
+
+
+def test_coalesce_events():
+    def message(receipt_handle, trigger, source):
+        return {
+            "ReceiptHandle": receipt_handle,
+            "Body": json.dumps({"trigger": trigger, "source": source}),
+        }
+
+    messages = [
+        message("1", "FILE.UPLOADED", {"id": "20", "name": "a.txt"}),
+        message("2", "FILE.RENAMED", {"id": "20", "name": "b.txt"}),
+        message("3", "FILE.RENAMED", {"id": "20", "name": "c.txt"}),
+        message("4", "FILE.TRASHED", {"id": "21"}),
+        message("5", "FILE.DELETED", {"id": "20"}),
+        message("6", "FOLDER.TRASHED", {"id": "100"}),
+        message("7", "FILE.RESTORED", {"id": "21"}),
+    ]
+
+    events = event_handler._coalesce_events(messages)
+
+    # 上書きされたイベントの ReceiptHandle は上書きしたイベントにまとめられる
+    # フォルダのイベントをまたいだイベントはまとめられない
+    assert [(e[0]["trigger"], e[1]) for e in events] == [
+        ("FILE.TRASHED", ["4"]),
+        ("FILE.DELETED", ["1", "2", "3", "5"]),
+        ("FOLDER.TRASHED", ["6"]),
+        ("FILE.RESTORED", ["7"]),
+    ]
+
+
+def test_partition_events():
+    def event(receipt_handle, trigger, item_id):
+        return {"trigger": trigger, "source": {"id": item_id}}, [receipt_handle]
+
+    events = [
+        event("1", "FILE.UPLOADED", "20"),
+        event("2", "FILE.UPLOADED", "21"),
+        event("3", "FILE.RENAMED", "20"),
+        event("4", "FOLDER.TRASHED", "100"),
+        event("5", "FILE.TRASHED", "22"),
+    ]
+
+    partitions = list(event_handler._partition_events(events, 2))
+
+    # 同じファイルのイベントは同じスレッドに順番に振り分けられる
+    # フォルダのイベントは単独で処理される
+    assert [[[e[1][0] for e in p] for p in ps] for ps in partitions] == [
+        [["1", "3"], ["2"]],
+        [["4"]],
+        [["5"]],
+    ]
+
+
+def test_failed_event_is_retried(mocker: MockFixture):
+    sqs_client = boto3.client("sqs")
+    queue_url = sqs_client.get_queue_url(
+        QueueName=os.environ["SQS_QUEUE_NAME"],
+    )["QueueUrl"]
+
+    owner = {"type": "user", "login": "test-user1@example.com"}
+    moved = {
+        "trigger": "FOLDER.MOVED",
+        "source": {"id": "500", "parent": {"id": "100"}},
+    }
+    uploaded = {
+        "trigger": "FILE.UPLOADED",
+        "source": {
+            "id": "5000",
+            "name": "test.txt",
+            "parent": {"id": "100"},
+            "created_at": "2012-12-12T10:53:43-08:00",
+            "modified_at": "2012-12-12T10:53:43-08:00",
+            "owned_by": owner,
+        },
+    }
+    for payload in (moved, uploaded):
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(payload))
+
+    event_handler.consume_messages()
+
+    # 失敗したイベントは再試行のテーブルに移され、後続のイベントは処理される
+    assert "Messages" not in sqs_client.receive_message(QueueUrl=queue_url)
+    assert File.get_by_id(5000).name == "test.txt"
+    failed_event = FailedEvent.get()
+    assert json.loads(failed_event.payload) == moved
+
+    # 再試行の時刻までは処理されない
+    Folder.create(id=500, name="a", parent_id=200, owner_type="user", owner_name="a")
+    event_handler.retry_failed_events()
+    assert Folder.get_by_id(500).parent_id == 200
+
+    FailedEvent.update(next_attempt_at=datetime(2000, 1, 1)).execute()
+    event_handler.retry_failed_events()
+    assert Folder.get_by_id(500).parent_id == 100
+    assert FailedEvent.select().count() == 0
+
+    # 上限まで失敗したイベントはテーブルに残して再試行しない
+    mocker.patch.object(event_handler.config, "EVENT_RETRY_MAX_ATTEMPTS", 2)
+    FailedEvent.create(
+        payload=json.dumps({**moved, "source": {"id": "501", "parent": {"id": "1"}}}),
+        item_id="501",
+        next_attempt_at=datetime(2000, 1, 1),
+    )
+    event_handler.retry_failed_events()
+    assert FailedEvent.get().attempts == 2
+    FailedEvent.update(next_attempt_at=datetime(2000, 1, 1)).execute()
+    event_handler.retry_failed_events()
+    assert FailedEvent.get().attempts == 2
+
+
+def test_failed_event_keeps_order(mocker: MockFixture):
+    uploaded = {
+        "trigger": "FILE.UPLOADED",
+        "source": {
+            "id": "7000",
+            "name": "test.txt",
+            "parent": {"id": "100"},
+            "created_at": "2012-12-12T10:53:43-08:00",
+            "modified_at": "2012-12-12T10:53:43-08:00",
+            "owned_by": {"type": "user", "login": "test-user1@example.com"},
+        },
+    }
+    trashed = {"trigger": "FILE.TRASHED", "source": {"id": "7000"}}
+    build_file_data = event_handler.build_file_data
+    mock_build = mocker.patch.object(
+        event_handler, "build_file_data", side_effect=Exception("Box error")
+    )
+
+    assert event_handler._process_events([(uploaded, ["1"])]) == ["1"]
+    # 前のイベントが再試行を待っている間は、後続のイベントも処理せずに後ろに並べる
+    assert event_handler._process_events([(trashed, ["2"])]) == ["2"]
+    assert FailedEvent.select().count() == 2
+
+    # 再試行ではアップロード、Trash の順に処理される
+    mock_build.side_effect = build_file_data
+    FailedEvent.update(next_attempt_at=datetime(2000, 1, 1)).execute()
+    event_handler.retry_failed_events()
+    assert File.get_by_id(7000).is_trashed
+    assert FailedEvent.select().count() == 0
+
+
+def test_consume_messages_stops_after_max_seconds(mocker: MockFixture):
+    sqs_client = boto3.client("sqs")
+    queue_url = sqs_client.get_queue_url(QueueName=os.environ["SQS_QUEUE_NAME"])[
+        "QueueUrl"
+    ]
+    mocker.patch.object(event_handler.config, "EVENT_BATCH_SIZE", 1)
+    # 受信するたびに時間が max_seconds を超えて進む時計にする
+    now = 0
+    receive_messages = event_handler._receive_messages
+
+    def slow_receive_messages(*args, **kwargs):
+        nonlocal now
+        now += 10
+        return receive_messages(*args, **kwargs)
+
+    mocker.patch.object(event_handler, "time").monotonic.side_effect = lambda: now
+    mocker.patch.object(
+        event_handler, "_receive_messages", side_effect=slow_receive_messages
+    )
+    for file_id in ("6000", "6001"):
+        payload = {"trigger": "FILE.TRASHED", "source": {"id": file_id}}
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(payload))
+
+    # イベントが残っていても max_seconds を過ぎたら戻る
+    event_handler.consume_messages(max_seconds=5)
+    res = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
+    assert len(res["Messages"]) == 1
@@ -0,0 +1,137 @@
+from box_connector import event_handler
+from box_connector.models import (
+    create_tables,
+    rebuild_folder_access,
+    File,
+    FolderAccess,
+)
+
+
+def _create_folder(folder_id: int, parent_id: int) -> None:
+    event_handler.process_folder_events(
+        {
+            "trigger": "FOLDER.CREATED",
+            "source": {
+                "id": folder_id,
+                "name": f"folder-{folder_id}",
+                "parent": {"id": parent_id},
+                "owned_by": {"type": "user", "login": "test-user1@example.com"},
+            },
+        }
+    )
+
+
+def _upload_file(file_id: int, parent_id: int) -> None:
+    event_handler.process_file_events(
+        {
+            "trigger": "FILE.UPLOADED",
+            "source": {
+                "id": file_id,
+                "name": f"file-{file_id}.txt",
+                "parent": {"id": parent_id},
+                "created_at": "2012-12-12T10:53:43-08:00",
+                "modified_at": "2012-12-12T10:53:43-08:00",
+                "owned_by": {"type": "user", "login": "test-user1@example.com"},
+            },
+        }
+    )
+
+
+def test_folder_trashed():
+    create_tables()
+
+    _create_folder(300, 100)
+    _create_folder(301, 300)
+    _create_folder(302, 301)
+    _create_folder(303, 100)
+    _upload_file(3000, 300)
+    _upload_file(3010, 301)
+    _upload_file(3020, 302)
+    _upload_file(3030, 303)
+    File.update(file_needs_update=False, metadata_needs_update=False).where(
+        File.id.in_([3000, 3010, 3020, 3030])
+    ).execute()
+
+    event_handler.process_folder_events(
+        {"trigger": "FOLDER.TRASHED", "source": {"id": 300}}
+    )
+
+    # 配下のファイルは全て Trash される
+    for file_id in (3000, 3010, 3020):
+        file = File.get(File.id == file_id)
+        assert file.is_trashed
+        assert file.file_needs_update
+        assert file.metadata_needs_update
+
+    # 配下ではないファイルは変更されない
+    file = File.get(File.id == 3030)
+    assert not file.is_trashed
+    assert not file.file_needs_update
+
+
+def _folder_access(folder_id: int) -> set[str]:
+    return {
+        access.accessible_name
+        for access in FolderAccess.select().where(FolderAccess.folder_id == folder_id)
+    }
+
+
+def _move_folder(folder_id: int, parent_id: int) -> None:
+    event_handler.process_folder_events(
+        {
+            "trigger": "FOLDER.MOVED",
+            "source": {"id": folder_id, "parent": {"id": parent_id}},
+        }
+    )
+
+
+def test_folder_access():
+    _create_folder(100, 0)
+    _create_folder(300, 100)
+    _create_folder(301, 300)
+    _create_folder(303, 100)
+    owner = "test-user1@example.com"
+    assert _folder_access(301) == {owner}
+
+    event_handler.process_collaboration_events(
+        {
+            "trigger": "COLLABORATION.ACCEPTED",
+            "source": {
+                "id": 9000,
+                "item": {"type": "folder", "id": 300, "name": "folder-300"},
+                "accessible_by": {"type": "user", "login": "test-user2@example.com"},
+                "status": "accepted",
+            },
+        }
+    )
+
+    # コラボレーションのアクセス権は配下のフォルダに継承される
+    assert _folder_access(300) == {owner, "test-user2@example.com"}
+    assert _folder_access(301) == {owner, "test-user2@example.com"}
+    assert _folder_access(303) == {owner}
+
+    # 移動すると移動先の親のアクセス権を継承する
+    _move_folder(301, 303)
+    assert _folder_access(301) == {owner}
+    _move_folder(301, 300)
+    assert _folder_access(301) == {owner, "test-user2@example.com"}
+
+    # 差分で更新した結果は作成し直した結果と一致する
+    def snapshot():
+        columns = (
+            FolderAccess.folder_id,
+            FolderAccess.source_folder_id,
+            FolderAccess.collaboration_id,
+            FolderAccess.accessible_name,
+        )
+        return list(FolderAccess.select(*columns).order_by(*columns).tuples())
+
+    incremental = snapshot()
+    rebuild_folder_access()
+    assert snapshot() == incremental
+
+    event_handler.process_collaboration_events(
+        {"trigger": "COLLABORATION.REMOVED", "source": {"id": 9000}}
+    )
+    assert _folder_access(300) == {owner}
+    assert _folder_access(301) == {owner}
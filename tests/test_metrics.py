@@ -0,0 +1,54 @@
+import json
+
+import boto3
+from pytest_mock import MockFixture
+
+from box_connector import metrics
+
+
+def test_metrics_summary():
+    recorder = metrics.Metrics()
+    recorder.increment("events.processed")
+    recorder.increment("events.processed", 2)
+    recorder.record("db.query", 0.5)
+    with recorder.timer("db.query"):
+        pass
+
+    summary = recorder.summary()
+    assert summary["counters"] == {"events.processed": 3}
+    assert summary["timers"]["db.query"]["calls"] == 2
+    assert summary["timers"]["db.query"]["max_seconds"] == 0.5
+
+    # boto3 の API の呼び出しごとに記録される
+    s3_client = boto3.client("s3")
+    recorder.instrument_boto3_client(s3_client, "s3")
+    s3_client.list_buckets()
+    assert recorder.summary()["timers"]["s3.ListBuckets"]["calls"] == 1
+
+    recorder.reset()
+    assert recorder.summary()["counters"] == {}
+
+
+def test_log_run_summary_emf(mocker: MockFixture):
+    mocker.patch.object(metrics.config, "METRICS_EMF", True)
+    mock_logger = mocker.patch.object(metrics, "logger")
+    metrics.metrics.increment("events.processed", 3)
+    metrics.metrics.record("s3.PutObject", 0.25)
+
+    metrics.log_run_summary("event_handler")
+
+    summary, emf = [call.args[0] for call in mock_logger.info.call_args_list]
+    assert summary["text"] == "Run summary"
+    assert summary["counters"]["events.processed"] == 3
+
+    # CloudWatch の Embedded Metric Format で出力される
+    directive = emf["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Dimensions"] == [["Run"]]
+    assert {"Name": "events.processed", "Unit": "Count"} in directive["Metrics"]
+    assert {"Name": "s3.PutObject.seconds", "Unit": "Seconds"} in directive["Metrics"]
+    assert emf["Run"] == "event_handler"
+    assert emf["events.processed"] == 3
+    json.dumps(emf)
+
+    # 出力したら集計をやり直す
+    assert metrics.metrics.summary()["counters"] == {}
@@ -0,0 +1,55 @@
+from box_connector.models import (
+    create_tables,
+    db,
+    FailedEvent,
+    File,
+    MIGRATIONS,
+    MODELS,
+    SchemaVersion,
+)
+
+
+def _column_type(table_name: str, column_name: str) -> str:
+    return {column.name: column.data_type for column in db.get_columns(table_name)}[
+        column_name
+    ]
+
+
+def test_create_tables_migrates_existing_tables():
+    # バージョンが記録されていない最初のリリースのテーブルを再現する
+    db.drop_tables([*MODELS, SchemaVersion])
+    db.execute_sql(
+        "CREATE TABLE file (id BIGINT PRIMARY KEY, name VARCHAR(255) NOT NULL,"
+        " parent_id VARCHAR(255), owner_type VARCHAR(255) NOT NULL,"
+        " owner_name VARCHAR(255) NOT NULL, created_at TIMESTAMP NOT NULL,"
+        " last_updated_at TIMESTAMP NOT NULL, is_trashed BOOLEAN NOT NULL,"
+        " is_deleted BOOLEAN NOT NULL, file_needs_update BOOLEAN NOT NULL,"
+        " metadata_needs_update BOOLEAN NOT NULL)"
+    )
+    db.execute_sql(
+        "CREATE TABLE folder (id BIGINT PRIMARY KEY, name VARCHAR(255) NOT NULL,"
+        " parent_id VARCHAR(255), owner_type VARCHAR(255) NOT NULL,"
+        " owner_name VARCHAR(255) NOT NULL)"
+    )
+    db.execute_sql(
+        "CREATE TABLE collaboration (id BIGINT PRIMARY KEY, item_id BIGINT NOT NULL,"
+        " item_type VARCHAR(255) NOT NULL, accessible_type VARCHAR(255) NOT NULL,"
+        " accessible_name VARCHAR(255) NOT NULL, status VARCHAR(255) NOT NULL)"
+    )
+    db.execute_sql(
+        "INSERT INTO file VALUES"
+        " (1, 'a.txt', '100', 'user', 'a', now(), now(), false, false, true, true)"
+    )
+
+    create_tables()
+
+    assert SchemaVersion.get().version == len(MIGRATIONS)
+    assert _column_type("file", "parent_id") == "bigint"
+    assert "file_file_needs_update" in {index.name for index in db.get_indexes("file")}
+    assert File.get_by_id(1).parent_id == 100
+    assert File.get_by_id(1).claimed_until is None
+    assert FailedEvent.table_exists()
+
+    # 適用済みなら何もしない
+    create_tables()
+    assert SchemaVersion.select().count() == 1
@@ -0,0 +1,190 @@
+import hashlib
+import io
+from datetime import datetime
+
+import boto3
+import pytest
+
+from box_connector import event_handler, s3_writer
+from box_connector.models import File
+
+
+def test_upload_file_multipart(monkeypatch):
+    s3_client = boto3.client("s3")
+    part_size = 5 * 1024 * 1024
+    monkeypatch.setattr(s3_writer.config, "S3_MULTIPART_PART_SIZE", part_size)
+
+    content = b"a" * (part_size * 2 + 100)
+    file = File(id=20, is_trashed=False, is_deleted=False)
+
+    s3_writer._upload_file((file, io.BytesIO(content)))
+
+    res = s3_client.get_object(
+        Bucket=s3_writer.config.BUCKET_NAME,
+        Key=s3_writer.config.S3_DOCUMENT_KEY_PREFIX + "20",
+    )
+    assert res["Body"].read() == content
+    # パートサイズを超えるファイルは分割してアップロードされる
+    assert res["ETag"].strip('"').endswith("-3")
+
+
+def test_download_file_not_ready(mocker):
+    # Box が HTTP 202 を返し続けて SDK が None を返した場合は失敗として再処理する
+    mocker.patch.object(
+        s3_writer.box_client.downloads, "download_file", return_value=None
+    )
+    file = File(id=40, is_trashed=False, is_deleted=False, sha1="0" * 40)
+    with pytest.raises(RuntimeError):
+        s3_writer._download_file(file)
+
+
+def test_save_metadata_unchanged(mocker):
+    resolver = mocker.Mock()
+    resolver.get_access_control_list.return_value = [
+        {"Access": "ALLOW", "Name": "test-user1@example.com", "Type": "USER"}
+    ]
+    file = File(
+        id=21,
+        name="test.txt",
+        created_at=datetime(2012, 12, 12),
+        last_updated_at=datetime(2012, 12, 12),
+    )
+
+    assert s3_writer._save_metadata(file, resolver)
+    # 同じ内容のメタデータはアップロードされない
+    assert not s3_writer._save_metadata(file, resolver)
+
+    resolver.get_access_control_list.return_value = []
+    assert s3_writer._save_metadata(file, resolver)
+
+
+def test_claim_chunks():
+    for file_id in range(5000, 5005):
+        File.create(
+            id=file_id,
+            name="test.txt",
+            owner_type="user",
+            owner_name="test-user1@example.com",
+            created_at=datetime(2012, 12, 12),
+            last_updated_at=datetime(2012, 12, 12),
+            is_trashed=False,
+            is_deleted=False,
+            file_needs_update=True,
+            metadata_needs_update=False,
+        )
+
+    writer_1 = s3_writer._claim_chunks(File.file_needs_update, 2)
+    writer_2 = s3_writer._claim_chunks(File.file_needs_update, 2)
+
+    # 確保済みのファイルは他の s3_writer からは処理されない
+    assert [f.id for f in next(writer_1)] == [5000, 5001]
+    assert [f.id for f in next(writer_2)] == [5002, 5003]
+    assert [f.id for f in next(writer_1)] == [5004]
+    assert next(writer_2, None) is None
+
+
+def test_commit_file_keeps_concurrent_update():
+    File.create(
+        id=7000,
+        name="test.txt",
+        owner_type="user",
+        owner_name="test-user1@example.com",
+        created_at=datetime(2012, 12, 12),
+        last_updated_at=datetime(2012, 12, 12),
+        is_trashed=False,
+        is_deleted=False,
+        file_needs_update=True,
+        metadata_needs_update=True,
+        sha1="0" * 40,
+    )
+    [file] = next(s3_writer._claim_chunks(File.file_needs_update, 10))
+
+    # アップロード中に Trash された
+    event_handler.process_file_events(
+        {"trigger": "FILE.TRASHED", "source": {"id": "7000"}}
+    )
+    s3_writer._commit_file((file, "uploaded"))
+
+    # Trash されたことは上書きされず、次回の実行で再処理される
+    stored = File.get_by_id(7000)
+    assert stored.is_trashed
+    assert stored.file_needs_update
+    assert stored.uploaded_sha1 is None
+    assert stored.claimed_until is None
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_write_files_stops_when_a_stage_dies(mocker, monkeypatch):
+    monkeypatch.setattr(s3_writer.config, "WRITER_QUEUE_SIZE", 1)
+    mocker.patch.object(s3_writer, "_PUT_TIMEOUT_SECONDS", 0.1)
+    mocker.patch.object(s3_writer, "_run_committer", side_effect=Exception("DB error"))
+    for file_id in range(6000, 6030):
+        File.create(
+            id=file_id,
+            name="test.txt",
+            owner_type="user",
+            owner_name="test-user1@example.com",
+            created_at=datetime(2012, 12, 12),
+            last_updated_at=datetime(2012, 12, 12),
+            is_trashed=True,
+            is_deleted=False,
+            file_needs_update=True,
+            metadata_needs_update=False,
+        )
+
+    # DB に反映するスレッドが止まっても待ち続けずに例外を投げる
+    with pytest.raises(RuntimeError):
+        s3_writer.write_files()
+
+
+def test_download_cache(mocker, tmp_path):
+    content = b"test-content"
+    sha1 = hashlib.sha1(content).hexdigest()
+    cache = s3_writer.DownloadCache(str(tmp_path), max_bytes=len(content) * 2)
+    mocker.patch.object(s3_writer, "download_cache", cache)
+    mock_download = mocker.patch.object(s3_writer.box_client.downloads, "download_file")
+    mock_download.side_effect = lambda file_id: io.BytesIO(content)
+
+    def fail_after_read(stream, key):
+        stream.read()
+        raise Exception("S3 error")
+
+    mocker.patch.object(s3_writer, "_stream_to_s3", side_effect=fail_after_read)
+
+    def file(file_id: int) -> File:
+        return File(id=file_id, is_trashed=False, is_deleted=False, sha1=sha1)
+
+    # アップロードに失敗しても、最後まで読み出した内容はキャッシュされる
+    with pytest.raises(Exception, match="S3 error"):
+        s3_writer._upload_file(s3_writer._download_file(file(30)))
+    mock_download.reset_mock()
+
+    _, stream = s3_writer._download_file(file(30))
+    assert stream.read() == content
+    stream.close()
+    mock_download.assert_not_called()
+
+    # SHA1 が一致しない内容はキャッシュされない
+    mocker.patch.object(
+        s3_writer, "_stream_to_s3", side_effect=lambda stream, key: stream.read()
+    )
+    s3_writer._upload_file(s3_writer._download_file(File(id=31, sha1="0" * 40)))
+    assert cache.open(File(id=31, sha1="0" * 40)) is None
+
+    # 上限を超えると最後に使われたのが古いものから削除される
+    s3_writer._upload_file((file(32), cache.wrap(file(32), io.BytesIO(content))))
+    cache.open(file(30)).close()
+    s3_writer._upload_file((file(33), cache.wrap(file(33), io.BytesIO(content))))
+    assert cache.open(file(32)) is None
+    stream = cache.open(file(30))
+    assert stream is not None
+    stream.close()
+
+    # 起動し直してもキャッシュを引き継ぐ
+    stream = s3_writer.DownloadCache(str(tmp_path), len(content) * 2).open(file(33))
+    assert stream is not None
+    stream.close()
+
+    # 開いている間に削除されて更新時刻を更新できなければキャッシュにないものとする
+    mocker.patch.object(s3_writer.os, "utime", side_effect=FileNotFoundError)
+    assert cache.open(file(33)) is None